@@ -1,13 +1,70 @@
+import asyncio
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import openai
 import tiktoken
-from openai import OpenAI
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+from openai import OpenAI, AsyncOpenAI
 
+from cache import EmbeddingCache, TTLCache
+from bm25 import tokenize
+from chunker import Chunker, Fragment, num_tokens
 from config import Config, GPTModel, EmbeddingModel
 
 
+class _TokenBucket:
+    """Blocks callers so that no more than tokens_per_minute tokens are spent per minute."""
+
+    def __init__(self, tokens_per_minute: int):
+        self._capacity = tokens_per_minute
+        self._tokens = tokens_per_minute
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _try_acquire(self, tokens: int) -> float:
+        """Take the tokens and return 0, or return the seconds to wait before trying again."""
+        # a request larger than the whole budget waits for a full bucket instead of forever
+        tokens = min(tokens, self._capacity)
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._capacity / 60)
+            self._updated = now
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0
+            return (tokens - self._tokens) * 60 / self._capacity
+
+    def acquire(self, tokens: int):
+        while (wait := self._try_acquire(tokens)) > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self, tokens: int):
+        while (wait := self._try_acquire(tokens)) > 0:
+            await asyncio.sleep(wait)
+
+
+_RETRYABLE_ERRORS = (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError,
+                     openai.APITimeoutError)
+# fragments sharing this share of their words with one already in the context are left out
+_DUPLICATE_SIMILARITY = 0.9
+# the tokens of the "N. " numbering and line break in front of each fragment of the prompt
+_NUMBERING_TOKENS = 3
+
+
+def _retry_wait(e: Exception, attempt: int) -> float:
+    """Seconds to wait before retrying, from the Retry-After header or an exponential backoff."""
+    response = getattr(e, 'response', None)
+    if response is not None:
+        try:
+            return float(response.headers.get('retry-after'))
+        except (TypeError, ValueError):
+            pass
+    return 2 ** attempt + random.random()
+
+
 class AI:
     """The AI class."""
 
@@ -17,35 +74,78 @@ class AI:
         self._embedding_model: EmbeddingModel = cfg.open_ai_embedding_model
         self._use_stream = cfg.use_stream
         self._encoding = tiktoken.encoding_for_model(self._chat_model.name)
+        self.chunker = Chunker(self._encoding, cfg.chunk_tokens, cfg.chunk_overlap_tokens)
         self._language = cfg.language
         self._temperature = cfg.temperature
-        self.client = OpenAI(api_key=cfg.open_ai_key)
+        self.client = OpenAI(api_key=cfg.open_ai_key, base_url=cfg.open_ai_base_url)
+        self._embedding_concurrency = cfg.embedding_concurrency
+        self._embedding_max_retries = cfg.embedding_max_retries
+        self._embedding_rate_limiter = _TokenBucket(cfg.embedding_tokens_per_minute) \
+            if cfg.embedding_tokens_per_minute > 0 else None
+        self._embedding_cache = EmbeddingCache(cfg.embedding_cache_path) if cfg.embedding_cache_path else None
+        self._query_cache = TTLCache(cfg.query_cache_size, cfg.query_cache_ttl)
+        self._use_keywords = cfg.use_keywords
+        self._context_max_tokens = cfg.context_max_tokens
+        self._context_min_score = cfg.context_min_score
+        self._context_mmr_lambda = cfg.context_mmr_lambda
+        self._prompt_tokens = None
+        # several times the results that fit in the context, for the packing to choose from
+        self.search_limit = 100 if cfg.context_max_tokens <= 0 else \
+            min(100, max(20, 3 * cfg.context_max_tokens // max(cfg.chunk_tokens, 50)))
 
     def _chat_stream(self, messages: list[dict], use_stream: bool = None) -> str:
         use_stream = use_stream if use_stream is not None else self._use_stream
+        if use_stream:
+            data = ""
+            metrics = {}
+            for content in self._chat_iter(messages, metrics):
+                data += content
+                print(content, end='')
+            print()
+            self.print_metrics(metrics)
+            return data.strip()
         response = self.client.chat.completions.create(
             n=1,
             temperature=self._temperature,
-            stream=use_stream,
+            stream=False,
             model=self._chat_model.name,
             messages=messages,
         )
-        if use_stream:
-            data = ""
-            for chunk in response:
-                if chunk.choices[0].delta.get('content', None) is not None:
-                    data += chunk.choices[0].delta.content
-                    print(chunk.choices[0].delta.content, end='')
-            print()
-            return data.strip()
-        else:
-            print(response.choices[0].message.content.strip())
-            input_cost = response.usage.prompt_tokens / 1000 * self._chat_model.input_price_per_k
-            output_cost = response.usage.completion_tokens / 1000 * self._chat_model.output_price_per_k
-            print(f"Total tokens: {response.usage.total_tokens}, cost: ${input_cost + output_cost}")
-            print(f"Input tokens: {response.usage.prompt_tokens}, cost: ${input_cost}")
-            print(f"Output tokens: {response.usage.completion_tokens}, cost: ${output_cost}")
-            return response.choices[0].message.content.strip()
+        return self._print_response(response)
+
+    def _chat_iter(self, messages: list[dict], metrics: dict = None):
+        """Yield the content of the completion as it is generated, timings are written to metrics."""
+        metrics = metrics if metrics is not None else {}
+        start = time.perf_counter()
+        response = self.client.chat.completions.create(
+            n=1,
+            temperature=self._temperature,
+            stream=True,
+            model=self._chat_model.name,
+            messages=messages,
+        )
+        for chunk in response:
+            if chunk.choices and chunk.choices[0].delta.content is not None:
+                metrics.setdefault('time_to_first_token', time.perf_counter() - start)
+                yield chunk.choices[0].delta.content
+        metrics['total_time'] = time.perf_counter() - start
+
+    @staticmethod
+    def print_metrics(metrics: dict):
+        """Print the prompt size and timings of a streamed completion."""
+        if 'prompt_tokens' in metrics:
+            print(f"Prompt tokens: {metrics['prompt_tokens']}, fragments: {metrics['fragments']}")
+        print(f"Time to first token: {metrics.get('time_to_first_token', 0):.3f}s, "
+              f"total time: {metrics['total_time']:.3f}s")
+
+    def _print_response(self, response) -> str:
+        print(response.choices[0].message.content.strip())
+        input_cost = response.usage.prompt_tokens / 1000 * self._chat_model.input_price_per_k
+        output_cost = response.usage.completion_tokens / 1000 * self._chat_model.output_price_per_k
+        print(f"Total tokens: {response.usage.total_tokens}, cost: ${input_cost + output_cost}")
+        print(f"Input tokens: {response.usage.prompt_tokens}, cost: ${input_cost}")
+        print(f"Output tokens: {response.usage.completion_tokens}, cost: ${output_cost}")
+        return response.choices[0].message.content.strip()
 
     def _num_tokens_from_string(self, string: str) -> int:
         """Returns the number of tokens in a text string."""
@@ -54,11 +154,29 @@ class AI:
 
     def completion(self, query: str, context: list[str]):
         """Create a completion."""
-        context = self._cut_texts(context)
-        print(f"Number of query fragments:{len(context)}")
+        return self._chat_stream(self._completion_messages(query, context))
+
+    def completion_stream(self, query: str, context: list[str], metrics: dict = None):
+        """Create a completion, yielding its content as it is generated, the size of its prompt and timings are
+        written to metrics."""
+        return self._chat_iter(self._completion_messages(query, context, metrics), metrics)
 
-        text = "\n".join(f"{index}. {text}" for index, text in enumerate(context))
-        result = self._chat_stream([
+    def _completion_messages(self, query: str, context: list[str], metrics: dict = None) -> list[dict]:
+        context, context_tokens = self._pack_context(context)
+        if self._prompt_tokens is None:
+            self._prompt_tokens = sum(self._num_tokens_from_string(m['content'])
+                                      for m in self._completion_prompt('', ''))
+        # the prompt is counted from the stored token counts, only the query is tokenized
+        prompt_tokens = self._prompt_tokens + context_tokens + _NUMBERING_TOKENS * len(context) + \
+            self._num_tokens_from_string(query)
+        print(f"Number of query fragments: {len(context)}, prompt tokens: {prompt_tokens}")
+        if metrics is not None:
+            metrics['fragments'] = len(context)
+            metrics['prompt_tokens'] = prompt_tokens
+        return self._completion_prompt(query, "\n".join(f"{index}. {text}" for index, text in enumerate(context)))
+
+    def _completion_prompt(self, query: str, text: str) -> list[dict]:
+        return [
             {'role': 'system',
              'content': f'You are a helpful AI article assistant. '
                         f'The following are the relevant article content fragments found from the article. '
@@ -69,79 +187,249 @@ class AI:
                         f'please answer "Current context cannot provide effective information."'
                         f'You must use {self._language} to respond.'},
             {'role': 'user', 'content': query},
-        ])
-        return result
+        ]
+
+    def fragment_tokens(self, text: str) -> int:
+        """The tokens of a text, only its label is tokenized if it is a fragment that knows its count."""
+        tokens = num_tokens(text)
+        if tokens is None:
+            return self._num_tokens_from_string(text)
+        return tokens + (self._num_tokens_from_string(text.label) if text.label else 0)
+
+    def _pack_context(self, context: list[str]) -> tuple[list[str], int]:
+        """Select the search results that go into the prompt, with their number of tokens.
+
+        Results scored below context_min_score are dropped. The rest are taken by maximal marginal relevance, the
+        relevance being the rank of the result and the redundancy the word overlap with the results already taken,
+        skipping near duplicates, until context_max_tokens is reached.
+        """
+        budget = self._chat_model.context_window - 1024
+        if self._context_max_tokens > 0:
+            budget = min(budget, self._context_max_tokens)
+        candidates = [text for text in context
+                      if getattr(text, 'score', None) is None or text.score >= self._context_min_score]
+        if len(candidates) < len(context):
+            print(f"Dropped {len(context) - len(candidates)} fragments scored below {self._context_min_score}")
+        diverse = self._context_mmr_lambda < 1
+        terms = [frozenset(tokenize(text[len(getattr(text, 'label', '')):])) for text in candidates] if diverse else []
+        redundancy = [0.0] * len(candidates)
+        remaining = list(range(len(candidates)))
+        selected = []
+        tokens = 0
+        while remaining:
+            if diverse:
+                best = max(remaining, key=lambda i: self._context_mmr_lambda * (1 - i / len(candidates)) -
+                           (1 - self._context_mmr_lambda) * redundancy[i])
+            else:
+                best = remaining[0]
+            remaining.remove(best)
+            if redundancy[best] >= _DUPLICATE_SIMILARITY:
+                continue
+            text_tokens = self.fragment_tokens(candidates[best])
+            if selected and tokens + text_tokens > budget:
+                print(f"Reached {tokens} tokens, packed {len(selected)} of {len(context)} fragments")
+                break
+            selected.append(best)
+            tokens += text_tokens
+            if diverse:
+                for i in remaining:
+                    union = len(terms[i] | terms[best])
+                    if union:
+                        redundancy[i] = max(redundancy[i], len(terms[i] & terms[best]) / union)
+        return [candidates[i] for i in selected], tokens
 
     def _cut_texts(self, context):
         maximum = self._chat_model.context_window - 1024
-        for index, text in enumerate(context):
-            maximum -= self._num_tokens_from_string(text)
-            if maximum < 0:
-                context = context[:index + 1]
-                print(f"Exceeded maximum length, cut the first {index + 1} fragments")
-                break
+        # the first fragment that crosses the maximum is the last one kept
+        total = np.cumsum([self.fragment_tokens(text) for text in context])
+        index = int(np.searchsorted(total, maximum, side='right'))
+        if index < len(context):
+            context = context[:index + 1]
+            print(f"Exceeded maximum length, cut the first {index + 1} fragments")
         return context
 
-    def get_keywords(self, query: str) -> str:
-        """Get keywords from the query."""
-        result = self._chat_stream([
+    @staticmethod
+    def _normalize_query(query: str) -> str:
+        return ' '.join(query.lower().split()).rstrip('?!.。？！')
+
+    def _keywords_key(self, query: str):
+        return 'keywords', self._chat_model.name, self._normalize_query(query)
+
+    def _query_embedding_key(self, text: str):
+        return 'embedding', self._embedding_model.name, self._normalize_query(text)
+
+    @staticmethod
+    def _keywords_messages(query: str) -> list[dict]:
+        return [
             {'role': 'user',
              'content': f'You need to extract keywords from the statement or question and '
                         f'return a series of keywords separated by commas.\ncontent: {query}\nkeywords: '},
-        ], use_stream=False)
+        ]
+
+    def get_keywords(self, query: str) -> str:
+        """Get keywords from the query."""
+        key = self._keywords_key(query)
+        result = self._query_cache.get(key)
+        if result is not None:
+            return result
+        result = self._chat_stream(self._keywords_messages(query), use_stream=False)
+        self._query_cache.put(key, result)
         return result
 
+    def get_query_embedding(self, query: str) -> (str, list[float]):
+        """Get the text to search with and its embedding, the keywords of the query or the query itself."""
+        text = self.get_keywords(query) if self._use_keywords else query
+        if len(text) == 0:
+            return text, None
+        key = self._query_embedding_key(text)
+        embedding = self._query_cache.get(key)
+        if embedding is None:
+            _, embedding = self.create_embedding(text)
+            self._query_cache.put(key, embedding)
+        return text, embedding
+
+    def get_query_embeddings(self, queries: list[str]) -> list[tuple[str, list[float]]]:
+        """Get the texts to search with and their embeddings for many queries, the texts missing from the query
+        cache are embedded together."""
+        texts = [self.get_keywords(query) for query in queries] if self._use_keywords else queries
+        embeddings, misses = self._lookup_query_embeddings(texts)
+        if misses:
+            created, _ = self._create_embeddings(list(misses.values()))
+            self._store_query_embeddings(embeddings, misses, created)
+        return [(text, embeddings.get(self._query_embedding_key(text)) if text else None) for text in texts]
+
+    def _lookup_query_embeddings(self, texts: list[str]) -> (dict, dict):
+        """The cached embeddings and the texts to embed, by query cache key, an empty text is not searched."""
+        embeddings = {}
+        misses = {}
+        for text in texts:
+            if not text:
+                continue
+            key = self._query_embedding_key(text)
+            if key in embeddings or key in misses:
+                continue
+            embedding = self._query_cache.get(key)
+            if embedding is None:
+                misses[key] = text
+            else:
+                embeddings[key] = embedding
+        return embeddings, misses
+
+    def _store_query_embeddings(self, embeddings: dict, misses: dict, created: list[tuple[str, list[float]]]):
+        for key, (_, embedding) in zip(misses, created):
+            embeddings[key] = embedding
+            self._query_cache.put(key, embedding)
+
     def _wrap_create_embedding(self, data):
+        # retries are done by _create_embedding_with_retry, so the client must not retry on its own
+        client = self.client.with_options(max_retries=0)
+        return client.embeddings.create(**self._embedding_params(data))
+
+    def _embedding_params(self, data) -> dict:
         if self._embedding_model.name != 'text-embedding-ada-002':
-            embedding = self.client.embeddings.create(
-                model=self._embedding_model.name,
-                input=data,
-                dimensions=1536,
-            )
+            return dict(model=self._embedding_model.name, input=data, dimensions=1536)
         else:
             # text-embedding-ada-002 does not support the dimensions parameter
-            embedding = self.client.embeddings.create(
-                model=self._embedding_model.name,
-                input=data,
-            )
-        return embedding
+            return dict(model=self._embedding_model.name, input=data)
+
+    def _create_embedding_with_retry(self, data, num_tokens: int):
+        """Create embeddings, retrying rate limits and server errors with exponential backoff."""
+        for attempt in range(self._embedding_max_retries + 1):
+            if self._embedding_rate_limiter is not None:
+                self._embedding_rate_limiter.acquire(num_tokens)
+            try:
+                return self._wrap_create_embedding(data)
+            except _RETRYABLE_ERRORS as e:
+                if attempt == self._embedding_max_retries:
+                    raise
+                wait = _retry_wait(e, attempt)
+                print(f"Embedding request failed ({e.__class__.__name__}), retry in {wait:.1f}s")
+                time.sleep(wait)
 
     def create_embedding(self, text: str) -> (str, list[float]):
         """Create an embedding for the provided text."""
-        embedding = self._wrap_create_embedding(text)
+        embedding = self._create_embedding_with_retry(text, self._num_tokens_from_string(text))
         return text, embedding.data[0].embedding
 
-    def create_embeddings(self, texts: list[str]) -> (list[tuple[str, list[float]]], int):
-        """Create embeddings for the provided input."""
-        result = []
+    def _slice_texts(self, texts: list[str]) -> list[tuple[list[str], int]]:
+        """Split the texts into slices that fit in one embedding request, with their token counts."""
+        slices = []
         query_len = 0
         start_index = 0
-        tokens = 0
-
-        def get_embedding(input_slice: list[str]):
-            embedding = self._wrap_create_embedding(input_slice)
-            return [(txt, data.embedding) for txt, data in
-                    zip(input_slice, embedding.data)], embedding.usage.total_tokens
-
         for index, text in enumerate(texts):
-            query_len += self._num_tokens_from_string(text)
+            query_len += self.fragment_tokens(text)
             if query_len > self._embedding_model.max_tokens - 1024:
-                ebd, tk = get_embedding(texts[start_index:index + 1])
-                print(f"Query fragments used tokens: {tk}, cost: ${tk / 1000 * self._embedding_model.price_per_k}")
+                slices.append((texts[start_index:index + 1], query_len))
                 query_len = 0
                 start_index = index + 1
-                tokens += tk
-                result.extend(ebd)
-
         if query_len > 0:
-            ebd, tk = get_embedding(texts[start_index:])
-            print(f"Query fragments used tokens: {tk}, cost: ${tk / 1000 * self._embedding_model.price_per_k}")
+            slices.append((texts[start_index:], query_len))
+        return slices
+
+    def create_embeddings(self, texts: list[str]) -> (list[tuple[str, list[float]]], int):
+        """Create embeddings for the provided input, only the texts missing from the cache are sent."""
+        if self._embedding_cache is None:
+            return self._create_embeddings(texts)
+
+        keys, cached, misses = self._lookup_embeddings(texts)
+        tokens = 0
+        if misses:
+            created, tokens = self._create_embeddings([text for _, text in misses])
+            self._store_embeddings(cached, misses, created)
+        return [(text, cached[key]) for key, text in zip(keys, texts)], tokens
+
+    def _lookup_embeddings(self, texts: list[str]) -> (list[str], dict, list[tuple[str, str]]):
+        """Get the cache keys of the texts, the cached embeddings and the (key, text) pairs to create."""
+        keys = [EmbeddingCache.key(self._embedding_model.name, self._embedding_model.dimensions, text)
+                for text in texts]
+        cached = self._embedding_cache.get_many(keys)
+        # repeated paragraphs, such as boilerplate of crawled pages, are embedded once
+        misses = list({key: text for key, text in zip(keys, texts) if key not in cached}.items())
+        print(f"Embedding cache hits: {sum(key in cached for key in keys)}, misses: {len(misses)}")
+        return keys, cached, misses
+
+    def _store_embeddings(self, cached: dict, misses: list[tuple[str, str]], created):
+        created = {key: embedding for (key, _), (_, embedding) in zip(misses, created)}
+        self._embedding_cache.put_many(created)
+        cached.update(created)
+
+    def _embedding_result(self, slice_texts: list[str], embedding) -> (list[tuple[str, list[float]]], int):
+        tk = embedding.usage.total_tokens
+        print(f"Query fragments used tokens: {tk}, cost: ${tk / 1000 * self._embedding_model.price_per_k}")
+        return [(txt, data.embedding) for txt, data in zip(slice_texts, embedding.data)], tk
+
+    def _create_embeddings(self, texts: list[str]) -> (list[tuple[str, list[float]]], int):
+        result = []
+        tokens = 0
+
+        def get_embedding(input_slice: tuple[list[str], int]):
+            slice_texts, num_tokens = input_slice
+            return self._embedding_result(slice_texts, self._create_embedding_with_retry(slice_texts, num_tokens))
+
+        slices = self._slice_texts(texts)
+        if self._embedding_concurrency > 1 and len(slices) > 1:
+            # map keeps the results in the order of the slices
+            with ThreadPoolExecutor(max_workers=self._embedding_concurrency) as executor:
+                embeddings = list(executor.map(get_embedding, slices))
+        else:
+            embeddings = map(get_embedding, slices)
+        for ebd, tk in embeddings:
             tokens += tk
             result.extend(ebd)
         return result, tokens
 
-    def generate_summary(self, embeddings, num_candidates=3, use_sif=False):
-        """Generate a summary for the provided embeddings."""
+    def generate_summary(self, candidate_paragraphs: list[str]):
+        """Generate a summary from the candidate paragraphs, see summary_candidates."""
+        return self._chat_stream(self._summary_messages(candidate_paragraphs))
+
+    def generate_summary_stream(self, candidate_paragraphs: list[str], metrics: dict = None):
+        """Generate a summary from the candidate paragraphs, yielding its content as it is generated."""
+        return self._chat_iter(self._summary_messages(candidate_paragraphs), metrics)
+
+    def summary_candidates(self, embeddings, num_candidates: int, use_sif: bool) -> tuple[list[float], list[str]]:
+        """The average embedding of the text and the paragraphs closest to it, to summarize the text from."""
+        from sklearn.metrics.pairwise import cosine_similarity
+
         avg_func = self._calc_paragraph_avg_embedding_with_sif if use_sif else self._calc_avg_embedding
         avg_embedding = np.array(avg_func(embeddings))
 
@@ -154,22 +442,24 @@ class AI:
         # 选择具有最高相似度分数的段落作为摘要的候选段落
         # Select the paragraph with the highest similarity score as the candidate paragraph for the summary.
         candidate_indices = np.argsort(similarity_scores)[::-1][:num_candidates]
-        candidate_paragraphs = [f"paragraph {i}: {paragraphs[i]}" for i in candidate_indices]
+        candidate_paragraphs = [Fragment(paragraphs[i], num_tokens(paragraphs[i]), f"paragraph {i}: ")
+                                for i in candidate_indices]
 
-        print("Calculation completed, start generating summary")
+        print("Calculation completed")
+        return avg_embedding.tolist(), candidate_paragraphs
 
+    def _summary_messages(self, candidate_paragraphs: list[str]) -> list[dict]:
         candidate_paragraphs = self._cut_texts(candidate_paragraphs)
 
         text = "\n".join(f"{index}. {text}" for index, text in enumerate(candidate_paragraphs))
-        result = self._chat_stream([
+        return [
             {'role': 'system',
              'content': f'As a helpful AI article assistant, '
                         f'I have retrieved the following relevant text fragments from the article, '
                         f'sorted by relevance from high to low. '
                         f'You need to summarize the entire article from these fragments, '
                         f'and present the final result in {self._language}:\n\n{text}\n\n{self._language} summary:'},
-        ])
-        return result
+        ]
 
     @staticmethod
     def _calc_avg_embedding(embeddings) -> list[float]:
@@ -182,38 +472,187 @@ class AI:
 
     @staticmethod
     def _calc_paragraph_avg_embedding_with_sif(paragraph_list) -> list[float]:
+        from sklearn.feature_extraction.text import CountVectorizer, TfidfVectorizer
+
         # calculate the SIF embedding for the entire text
         alpha = 0.001
-        # calculate the total number of sentences
-        n_sentences = len(paragraph_list)
-
-        # calculate the total number of dimensions in the embeddings
-        n_dims = len(paragraph_list[0][1])
+        paragraphs = [paragraph for paragraph, _ in paragraph_list]
 
         # calculate the IDF values for each word in the sentences
         vectorizer = TfidfVectorizer(use_idf=True)
-        vectorizer.fit_transform([paragraph for paragraph, _ in paragraph_list])
-        idf = vectorizer.idf_
-
-        # calculate the SIF weights for each sentence
-        weights = np.zeros((n_sentences, n_dims))
-        for i, (sentence, embedding) in enumerate(paragraph_list):
-            sentence_words = sentence.split()
-            for word in sentence_words:
-                try:
-                    word_index = vectorizer.vocabulary_[word]
-                    word_idf = idf[word_index]
-                    word_weight = alpha / (alpha + word_idf)
-                    weights[i] += word_weight * (np.array(embedding) / np.max(embedding))
-                except KeyError:
-                    pass
-
-        # calculate the weighted average of the sentence embeddings
-        weights_sum = np.sum(weights, axis=0)
-        weights_sum /= n_sentences
-        avg_embedding = np.zeros(n_dims)
-        for i, (sentence, embedding) in enumerate(paragraph_list):
-            avg_embedding += (np.array(embedding) / np.max(embedding)) - weights[i]
-        avg_embedding /= n_sentences
+        vectorizer.fit(paragraphs)
+        word_weights = alpha / (alpha + vectorizer.idf_)
+
+        # the SIF weight of a sentence is the sum of the weights of its words, the words are counted the way
+        # they are looked up in the vocabulary, split on whitespace and not lowercased
+        counter = CountVectorizer(vocabulary=vectorizer.vocabulary_, tokenizer=str.split, lowercase=False,
+                                  token_pattern=None)
+        weights = counter.transform(paragraphs) @ word_weights
+
+        # the average of the normalized sentence embeddings, each reduced by its weighted copy
+        embeddings = np.array([embedding for _, embedding in paragraph_list])
+        embeddings /= embeddings.max(axis=1, keepdims=True)
+        avg_embedding = (1 - weights) @ embeddings / len(paragraph_list)
 
         return avg_embedding.tolist()
+
+
+class AsyncAI(AI):
+    """The AI class for asyncio, built on AsyncOpenAI.
+
+    Network calls are awaited and CPU bound work such as tokenizing runs in threads, so a coroutine never
+    blocks the event loop for long.
+    """
+
+    def __init__(self, cfg: Config):
+        super().__init__(cfg)
+        self.async_client = AsyncOpenAI(api_key=cfg.open_ai_key, base_url=cfg.open_ai_base_url)
+        self._embedding_semaphore = asyncio.Semaphore(self._embedding_concurrency)
+
+    async def _chat_stream(self, messages: list[dict], use_stream: bool = None) -> str:
+        use_stream = use_stream if use_stream is not None else self._use_stream
+        if use_stream:
+            data = ""
+            metrics = {}
+            async for content in self._chat_iter(messages, metrics):
+                data += content
+            self.print_metrics(metrics)
+            return data.strip()
+        response = await self.async_client.chat.completions.create(
+            n=1,
+            temperature=self._temperature,
+            stream=False,
+            model=self._chat_model.name,
+            messages=messages,
+        )
+        return self._print_response(response)
+
+    async def _chat_iter(self, messages: list[dict], metrics: dict = None):
+        """Yield the content of the completion as it is generated, timings are written to metrics."""
+        metrics = metrics if metrics is not None else {}
+        start = time.perf_counter()
+        response = await self.async_client.chat.completions.create(
+            n=1,
+            temperature=self._temperature,
+            stream=True,
+            model=self._chat_model.name,
+            messages=messages,
+        )
+        async for chunk in response:
+            if chunk.choices and chunk.choices[0].delta.content is not None:
+                metrics.setdefault('time_to_first_token', time.perf_counter() - start)
+                yield chunk.choices[0].delta.content
+        metrics['total_time'] = time.perf_counter() - start
+
+    async def completion(self, query: str, context: list[str]):
+        """Create a completion."""
+        messages = await asyncio.to_thread(self._completion_messages, query, context)
+        return await self._chat_stream(messages)
+
+    async def completion_stream(self, query: str, context: list[str], metrics: dict = None):
+        """Create a completion, yielding its content as it is generated, the size of its prompt and timings are
+        written to metrics."""
+        messages = await asyncio.to_thread(self._completion_messages, query, context, metrics)
+        async for content in self._chat_iter(messages, metrics):
+            yield content
+
+    async def get_keywords(self, query: str) -> str:
+        """Get keywords from the query."""
+        key = self._keywords_key(query)
+        result = self._query_cache.get(key)
+        if result is not None:
+            return result
+        result = await self._chat_stream(self._keywords_messages(query), use_stream=False)
+        self._query_cache.put(key, result)
+        return result
+
+    async def get_query_embedding(self, query: str) -> (str, list[float]):
+        """Get the text to search with and its embedding, the keywords of the query or the query itself."""
+        text = await self.get_keywords(query) if self._use_keywords else query
+        if len(text) == 0:
+            return text, None
+        key = self._query_embedding_key(text)
+        embedding = self._query_cache.get(key)
+        if embedding is None:
+            _, embedding = await self.create_embedding(text)
+            self._query_cache.put(key, embedding)
+        return text, embedding
+
+    async def get_query_embeddings(self, queries: list[str], concurrency: int = 8) -> list[tuple[str, list[float]]]:
+        """Get the texts to search with and their embeddings for many queries, the texts missing from the query
+        cache are embedded together, at most concurrency keyword requests are in flight."""
+        if self._use_keywords:
+            semaphore = asyncio.Semaphore(concurrency)
+
+            async def get_keywords(query: str) -> str:
+                async with semaphore:
+                    return await self.get_keywords(query)
+
+            texts = await asyncio.gather(*(get_keywords(query) for query in queries))
+        else:
+            texts = queries
+        embeddings, misses = self._lookup_query_embeddings(texts)
+        if misses:
+            created, _ = await self._create_embeddings(list(misses.values()))
+            self._store_query_embeddings(embeddings, misses, created)
+        return [(text, embeddings.get(self._query_embedding_key(text)) if text else None) for text in texts]
+
+    async def _create_embedding_with_retry(self, data, num_tokens: int):
+        """Create embeddings, retrying rate limits and server errors with exponential backoff."""
+        client = self.async_client.with_options(max_retries=0)
+        for attempt in range(self._embedding_max_retries + 1):
+            if self._embedding_rate_limiter is not None:
+                await self._embedding_rate_limiter.acquire_async(num_tokens)
+            try:
+                async with self._embedding_semaphore:
+                    return await client.embeddings.create(**self._embedding_params(data))
+            except _RETRYABLE_ERRORS as e:
+                if attempt == self._embedding_max_retries:
+                    raise
+                wait = _retry_wait(e, attempt)
+                print(f"Embedding request failed ({e.__class__.__name__}), retry in {wait:.1f}s")
+                await asyncio.sleep(wait)
+
+    async def create_embedding(self, text: str) -> (str, list[float]):
+        """Create an embedding for the provided text."""
+        embedding = await self._create_embedding_with_retry(text, self._num_tokens_from_string(text))
+        return text, embedding.data[0].embedding
+
+    async def create_embeddings(self, texts: list[str]) -> (list[tuple[str, list[float]]], int):
+        """Create embeddings for the provided input, only the texts missing from the cache are sent."""
+        if self._embedding_cache is None:
+            return await self._create_embeddings(texts)
+
+        keys, cached, misses = await asyncio.to_thread(self._lookup_embeddings, texts)
+        tokens = 0
+        if misses:
+            created, tokens = await self._create_embeddings([text for _, text in misses])
+            await asyncio.to_thread(self._store_embeddings, cached, misses, created)
+        return [(text, cached[key]) for key, text in zip(keys, texts)], tokens
+
+    async def _create_embeddings(self, texts: list[str]) -> (list[tuple[str, list[float]]], int):
+        async def get_embedding(input_slice: tuple[list[str], int]):
+            slice_texts, num_tokens = input_slice
+            return self._embedding_result(slice_texts,
+                                          await self._create_embedding_with_retry(slice_texts, num_tokens))
+
+        slices = await asyncio.to_thread(self._slice_texts, texts)
+        # gather keeps the results in the order of the slices, the semaphore bounds the requests in flight
+        embeddings = await asyncio.gather(*(get_embedding(input_slice) for input_slice in slices))
+        result = []
+        tokens = 0
+        for ebd, tk in embeddings:
+            tokens += tk
+            result.extend(ebd)
+        return result, tokens
+
+    async def generate_summary(self, candidate_paragraphs: list[str]):
+        """Generate a summary from the candidate paragraphs, see summary_candidates."""
+        messages = await asyncio.to_thread(self._summary_messages, candidate_paragraphs)
+        return await self._chat_stream(messages)
+
+    async def generate_summary_stream(self, candidate_paragraphs: list[str], metrics: dict = None):
+        """Generate a summary from the candidate paragraphs, yielding its content as it is generated."""
+        messages = await asyncio.to_thread(self._summary_messages, candidate_paragraphs)
+        async for content in self._chat_iter(messages, metrics):
+            yield content
@@ -1,5 +1,11 @@
+import asyncio
+import json
 import os
 import shutil
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 
 import uvicorn
 import xxhash
@@ -8,41 +14,108 @@ from fastapi.exceptions import RequestValidationError
 from pydantic import BaseModel
 from starlette.exceptions import HTTPException
 from starlette.requests import Request
-from starlette.responses import JSONResponse
+from starlette.responses import JSONResponse, StreamingResponse
 
-from ai import AI
+from ai import AI, AsyncAI
 from config import Config
 from contents import web_crawler_newspaper, extract_text_from_txt, extract_text_from_docx, \
-    extract_text_from_pdf
+    iter_pdf_paragraphs, set_chrome_pool_size
+from ingest import get_hash_id, index_summary, summary_candidates, get_summary, set_summary, sitemap_urls, \
+    save_to_storage, save_stream_to_storage, chunk_contents, BulkIngest
+from jobs import Job, JobQueue
 from storage import Storage
 
 
-def api(cfg: Config):
-    """Run the API."""
+def create_app(cfg: Optional[Config] = None) -> FastAPI:
+    """Create the API app, reading config.json if no config is given.
 
+    This is the app factory of every worker process, e.g. `uvicorn --factory api:create_app --workers 4`.
+    """
+    cfg = cfg or Config()
     cfg.use_stream = False
-    ai = AI(cfg)
+    ai = AsyncAI(cfg)
+    # for ingestion that runs on the executors from start to end
+    blocking_ai = AI(cfg)
+    # blocking work runs on bounded executors instead of the event loop, the crawler gets its own small
+    # pool so that slow pages can not starve searches
+    executor = ThreadPoolExecutor(max_workers=cfg.api_executor_workers)
+    crawler_executor = ThreadPoolExecutor(max_workers=cfg.api_crawler_workers)
+    set_chrome_pool_size(cfg.api_crawler_workers)
+    # built by the first /ingest request, most processes never serve one
+    bulk_ingest = None
+    bulk_ingest_lock = threading.Lock()
+    # /crawler_url and /upload_file return a job id at once and the document is ingested in the background
+    jobs = JobQueue(cfg.job_state_path, cfg.api_job_workers, cfg.api_job_queue_size) if cfg.api_job_queue else None
 
     app = FastAPI()
 
+    async def run_blocking(pool, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(pool, func, *args)
+
+    def get_bulk_ingest() -> BulkIngest:
+        nonlocal bulk_ingest
+        with bulk_ingest_lock:
+            if bulk_ingest is None:
+                bulk_ingest = BulkIngest(cfg)
+            return bulk_ingest
+
+    async def submit_job(kind: str, source: str, key: str, func) -> dict:
+        try:
+            job, in_flight = await run_blocking(executor, jobs.submit, kind, source, key, func)
+        except ValueError as e:
+            return {"code": 1, "msg": str(e), "data": {}}
+        return {"code": 0, "msg": "ok", "data": {"job": job, "in_flight": in_flight}}
+
+    def store_job(job: Job, contents: list[str], lang: str) -> dict:
+        if not contents:
+            raise ValueError('no content')
+        hash_id = get_hash_id(contents)
+        job.claim(hash_id)
+        job.progress('embedding', paragraphs=len(contents))
+        tokens = save_to_storage(blocking_ai, Storage.create_storage(cfg), contents, hash_id, lang)
+        return {"uri": f"{hash_id}/{lang}", "tokens": tokens}
+
+    def crawl_job(job: Job, url: str) -> dict:
+        job.progress('crawling')
+        contents, lang = web_crawler_newspaper(url)
+        return store_job(job, contents, lang)
+
+    def file_job(job: Job, path: str, extract) -> dict:
+        try:
+            if extract is None:
+                job.progress('embedding')
+                hash_id, lang, tokens = save_stream_to_storage(blocking_ai, Storage.create_storage(cfg),
+                                                               iter_pdf_paragraphs(path, cfg.pdf_workers),
+                                                               claim=job.claim)
+                return {"uri": f"{hash_id}/{lang}", "tokens": tokens}
+            job.progress('extracting')
+            contents, lang = extract(path)
+        finally:
+            os.remove(path)
+        return store_job(job, contents, lang)
+
     class CrawlerUrlRequest(BaseModel):
         url: str
 
     @app.post("/crawler_url")
     async def crawler_url(req: CrawlerUrlRequest):
         """Crawler the URL."""
-        contents, lang = web_crawler_newspaper(req.url)
-        hash_id = xxhash.xxh3_128_hexdigest('\n'.join(contents))
-        tokens = _save_to_storage(contents, hash_id)
+        if jobs is not None:
+            return await submit_job('crawl', req.url, req.url, lambda job: crawl_job(job, req.url))
+        contents, lang = await run_blocking(crawler_executor, web_crawler_newspaper, req.url)
+        hash_id = get_hash_id(contents)
+        tokens = await _save_to_storage(contents, hash_id, lang)
         return {"code": 0, "msg": "ok", "data": {"uri": f"{hash_id}/{lang}", "tokens": tokens}}
 
-    def _save_to_storage(contents, hash_id):
+    async def _save_to_storage(contents, hash_id, lang):
         storage = Storage.create_storage(cfg)
-        if storage.been_indexed(hash_id):
+        if await run_blocking(executor, storage.been_indexed, hash_id):
             return 0
         else:
-            embeddings, tokens = ai.create_embeddings(contents)
-            storage.add_all(embeddings, hash_id)
+            chunks = await run_blocking(executor, chunk_contents, ai, contents)
+            embeddings, tokens = await ai.create_embeddings(chunks)
+            await run_blocking(executor, storage.add_all, embeddings, hash_id)
+            await run_blocking(executor, index_summary, ai, storage, embeddings, hash_id, lang)
             return tokens
 
     @app.post("/upload_file")
@@ -52,21 +125,95 @@ def api(cfg: Config):
         file_name = file.filename
         os.makedirs('./upload', exist_ok=True)
         upload_path = os.path.join('./upload', file_name)
-        with open(upload_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+
+        def save_file(path):
+            with open(path, "wb") as buffer:
+                shutil.copyfileobj(file.file, buffer)
+
         if file_name.endswith('.pdf'):
-            contents, lang = extract_text_from_pdf(upload_path)
+            extract = None
         elif file_name.endswith('.txt'):
-            contents, lang = extract_text_from_txt(upload_path)
+            extract = extract_text_from_txt
         elif file_name.endswith('.docx'):
-            contents, lang = extract_text_from_docx(upload_path)
+            extract = extract_text_from_docx
         else:
             return {"code": 1, "msg": "not support", "data": {}}
-        hash_id = xxhash.xxh3_128_hexdigest('\n'.join(contents))
-        tokens = _save_to_storage(contents, hash_id)
+        if jobs is not None:
+            # a job has its own copy of the file, and the same bytes are ingested by one job at a time
+            job_path = os.path.join('./upload', f'{uuid.uuid4().hex}_{os.path.basename(file_name)}')
+            await run_blocking(executor, save_file, job_path)
+            digest = await run_blocking(executor, _file_digest, job_path)
+            response = await submit_job('upload', file_name, digest, lambda job: file_job(job, job_path, extract))
+            if response['code'] or response['data']['in_flight']:
+                os.remove(job_path)
+            return response
+        await run_blocking(executor, save_file, upload_path)
+        if extract is None:
+            # PDFs are embedded while their pages are extracted
+            paragraphs = iter_pdf_paragraphs(upload_path, cfg.pdf_workers)
+            try:
+                hash_id, lang, tokens = await run_blocking(executor, save_stream_to_storage, blocking_ai,
+                                                           Storage.create_storage(cfg), paragraphs)
+            except ValueError as e:
+                return {"code": 1, "msg": str(e), "data": {}}
+            finally:
+                os.remove(upload_path)
+            return {"code": 0, "msg": "ok", "data": {"uri": f"{hash_id}/{lang}", "tokens": tokens}}
+        contents, lang = await run_blocking(executor, extract, upload_path)
+        hash_id = get_hash_id(contents)
+        tokens = await _save_to_storage(contents, hash_id, lang)
         os.remove(upload_path)
         return {"code": 0, "msg": "ok", "data": {"uri": f"{hash_id}/{lang}", "tokens": tokens}}
 
+    class IngestRequest(BaseModel):
+        urls: list[str] = []
+        sitemap: Optional[str] = None
+        run: Optional[str] = None
+
+    @app.post("/ingest")
+    async def ingest(req: IngestRequest):
+        """Ingest many URLs in the background, or resume a run with its unfinished URLs."""
+        urls = list(req.urls)
+        if req.sitemap:
+            urls += await run_blocking(executor, sitemap_urls, req.sitemap)
+        if not urls and not req.run:
+            return {"code": 1, "msg": "no urls", "data": {}}
+        bulk = await run_blocking(executor, get_bulk_ingest)
+        run = req.run or uuid.uuid4().hex
+        # the run is claimed in the shared state, so that no other request or process of the API runs it too
+        if not await run_blocking(executor, bulk.claim, run):
+            return {"code": 1, "msg": "run is in progress", "data": {"run": run}}
+        try:
+            await run_blocking(executor, bulk.add, urls, run)
+        except Exception:
+            await run_blocking(executor, bulk.release, run)
+            raise
+        threading.Thread(target=bulk.run, args=(run, True), daemon=True).start()
+        return {"code": 0, "msg": "ok", "data": {"run": run, "urls": len(urls)}}
+
+    @app.get("/ingest_status")
+    async def ingest_status(run: str, items: bool = False):
+        """The status of an ingestion run."""
+        bulk = await run_blocking(executor, get_bulk_ingest)
+        return {"code": 0, "msg": "ok", "data": await run_blocking(executor, bulk.status, run, items)}
+
+    @app.get("/job_status")
+    async def job_status(job: str):
+        """The status of a /crawler_url or /upload_file job, with the uri of the document once it is done."""
+        if jobs is None:
+            return {"code": 1, "msg": "the job queue is disabled", "data": {}}
+        status = await run_blocking(executor, jobs.status, job)
+        if status is None:
+            return {"code": 1, "msg": "not found", "data": {}}
+        return {"code": 0, "msg": "ok", "data": status}
+
+    @app.get("/jobs")
+    async def list_jobs(status: Optional[str] = None, limit: int = 50):
+        """The most recent jobs."""
+        if jobs is None:
+            return {"code": 1, "msg": "the job queue is disabled", "data": {}}
+        return {"code": 0, "msg": "ok", "data": {"jobs": await run_blocking(executor, jobs.jobs, status, limit)}}
+
     @app.get("/summary")
     async def summary(uri: str):
         """Generate summary."""
@@ -74,10 +221,49 @@ def api(cfg: Config):
         storage = Storage.create_storage(cfg)
         if not storage or not lang:
             return {"code": 1, "msg": "not found", "data": {}}
-        s = ai.generate_summary(storage.get_all_embeddings(hash_id), num_candidates=100,
-                                use_sif=lang not in ['zh', 'ja', 'ko', 'hi', 'ar', 'fa'])
+        # the summary is generated once per document, model and language
+        s = await run_blocking(executor, get_summary, ai, storage, hash_id)
+        if s is None:
+            candidates = await run_blocking(executor, summary_candidates, ai, storage, hash_id, lang)
+            s = await ai.generate_summary(candidates)
+            await run_blocking(executor, set_summary, ai, storage, hash_id, s)
         return {"code": 0, "msg": "ok", "data": {"summary": s}}
 
+    async def _server_sent_events(contents, metrics: dict):
+        async for content in contents:
+            yield f"data: {json.dumps({'content': content}, ensure_ascii=False)}\n\n"
+        ai.print_metrics(metrics)
+        # the metrics event also marks the end of the stream
+        yield f"event: metrics\ndata: {json.dumps(metrics)}\n\n"
+
+    async def _stored_summary(summary):
+        yield summary
+
+    async def _store_summary(contents, storage, hash_id):
+        """Pass the summary through, storing it once it is complete."""
+        summary = ''
+        async for content in contents:
+            summary += content
+            yield content
+        await run_blocking(executor, set_summary, ai, storage, hash_id, summary.strip())
+
+    @app.get("/summary_stream")
+    async def summary_stream(uri: str):
+        """Generate summary, streamed as server-sent events."""
+        hash_id, lang = uri.split('/')
+        storage = Storage.create_storage(cfg)
+        if not storage or not lang:
+            return {"code": 1, "msg": "not found", "data": {}}
+        s = await run_blocking(executor, get_summary, ai, storage, hash_id)
+        if s is not None:
+            metrics = {'time_to_first_token': 0, 'total_time': 0, 'cached': True}
+            contents = _stored_summary(s)
+        else:
+            candidates = await run_blocking(executor, summary_candidates, ai, storage, hash_id, lang)
+            metrics = {}
+            contents = _store_summary(ai.generate_summary_stream(candidates, metrics=metrics), storage, hash_id)
+        return StreamingResponse(_server_sent_events(contents, metrics), media_type="text/event-stream")
+
     class AnswerRequest(BaseModel):
         uri: str
         query: str
@@ -89,12 +275,101 @@ def api(cfg: Config):
         storage = Storage.create_storage(cfg)
         if not storage or not lang:
             return {"code": 1, "msg": "not found", "data": {}}
-        keywords = ai.get_keywords(req.query)
-        _, embedding = ai.create_embedding(keywords)
-        texts = storage.get_texts(embedding, hash_id)
-        s = ai.completion(req.query, texts)
+        keywords, embedding = await ai.get_query_embedding(req.query)
+        if embedding is None:
+            return {"code": 1, "msg": "empty query", "data": {}}
+        texts = await run_blocking(executor, storage.get_texts, embedding, hash_id, ai.search_limit, keywords)
+        s = await ai.completion(req.query, texts)
+        return {"code": 0, "msg": "ok", "data": {"answer": s}}
+
+    @app.get("/answer_stream")
+    async def answer_stream(uri: str, query: str):
+        """Query, the answer is streamed as server-sent events."""
+        hash_id, lang = uri.split('/')
+        storage = Storage.create_storage(cfg)
+        if not storage or not lang:
+            return {"code": 1, "msg": "not found", "data": {}}
+        keywords, embedding = await ai.get_query_embedding(query)
+        if embedding is None:
+            return {"code": 1, "msg": "empty query", "data": {}}
+        texts = await run_blocking(executor, storage.get_texts, embedding, hash_id, ai.search_limit, keywords)
+        metrics = {}
+        contents = ai.completion_stream(query, texts, metrics=metrics)
+        return StreamingResponse(_server_sent_events(contents, metrics), media_type="text/event-stream")
+
+    class AnswerBatchRequest(BaseModel):
+        uri: str
+        queries: list[str]
+
+    @app.post("/answer_batch")
+    async def answer_batch(req: AnswerBatchRequest):
+        """Query many times, the answers are in the order of the queries, null for an empty query."""
+        hash_id, lang = req.uri.split('/')
+        storage = Storage.create_storage(cfg)
+        if not storage or not lang:
+            return {"code": 1, "msg": "not found", "data": {}}
+        # blank queries are not sent to the keyword model, which would make up keywords for them
+        asked = [i for i, query in enumerate(req.queries) if query.strip()]
+        searches = await ai.get_query_embeddings([req.queries[i] for i in asked], cfg.api_batch_concurrency)
+        found = [(i, search) for i, search in zip(asked, searches) if search[1] is not None]
+        texts = await run_blocking(executor, storage.get_texts_batch, [search[1] for _, search in found], hash_id,
+                                   ai.search_limit, [search[0] for _, search in found])
+
+        semaphore = asyncio.Semaphore(cfg.api_batch_concurrency)
+
+        async def complete(query, query_texts):
+            async with semaphore:
+                return await ai.completion(query, query_texts)
+
+        answers = [None] * len(req.queries)
+        results = await asyncio.gather(*(complete(req.queries[i], t) for (i, _), t in zip(found, texts)))
+        for (i, _), s in zip(found, results):
+            answers[i] = s
+        return {"code": 0, "msg": "ok", "data": {"answers": answers}}
+
+    class CollectionRequest(BaseModel):
+        collection: str
+        uris: list[str]
+
+    @app.post("/collection")
+    async def create_collection(req: CollectionRequest):
+        """Create or replace a collection of documents that are searched together."""
+        storage = Storage.create_storage(cfg)
+        names = [uri.split('/')[0] for uri in req.uris]
+        try:
+            await run_blocking(executor, storage.create_collection, req.collection, names)
+        except ValueError as e:
+            return {"code": 1, "msg": str(e), "data": {}}
+        return {"code": 0, "msg": "ok", "data": {"collection": req.collection}}
+
+    class CollectionAnswerRequest(BaseModel):
+        collection: str
+        query: str
+
+    @app.get("/collection_answer")
+    async def collection_answer(req: CollectionAnswerRequest):
+        """Query all documents of a collection."""
+        storage = Storage.create_storage(cfg)
+        keywords, embedding = await ai.get_query_embedding(req.query)
+        if embedding is None:
+            return {"code": 1, "msg": "empty query", "data": {}}
+        try:
+            texts = await run_blocking(executor, storage.get_collection_texts, embedding, req.collection,
+                                       ai.search_limit, keywords)
+        except ValueError as e:
+            return {"code": 1, "msg": str(e), "data": {}}
+        s = await ai.completion(req.query, texts)
         return {"code": 0, "msg": "ok", "data": {"answer": s}}
 
+    @app.get("/stats")
+    async def stats():
+        """Storage statistics."""
+        storage = Storage.create_storage(cfg)
+        data = await run_blocking(executor, storage.stats)
+        if jobs is not None:
+            data['job_queue'] = await run_blocking(executor, jobs.counts)
+        return {"code": 0, "msg": "ok", "data": data}
+
     @app.exception_handler(RequestValidationError)
     async def validate_error_handler(request: Request, exc: RequestValidationError):
         """Error handler."""
@@ -113,5 +388,21 @@ def api(cfg: Config):
             content={"code": 1, "msg": exc.detail, "data": {}},
         )
 
-    # run the API
-    uvicorn.run(app, host=cfg.api_host, port=cfg.api_port)
+    return app
+
+
+def _file_digest(path: str) -> str:
+    hasher = xxhash.xxh3_128()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def api(cfg: Config):
+    """Run the API."""
+    if cfg.api_workers > 1:
+        # the worker processes import the app factory, each creates its own app from config.json
+        uvicorn.run('api:create_app', factory=True, host=cfg.api_host, port=cfg.api_port, workers=cfg.api_workers)
+    else:
+        uvicorn.run(create_app(cfg), host=cfg.api_host, port=cfg.api_port)
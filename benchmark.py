@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Benchmarks of the search and summary internals, run `python3 benchmark.py -h` for the list."""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import types
+
+import faiss
+import numpy as np
+
+from storage import _create_index
+
+
+def _synthetic_vectors(n: int, dims: int, seed: int = 0) -> np.ndarray:
+    """Unit vectors around a few hundred topics, closer to paragraph embeddings than uniform noise."""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(max(1, n // 100), dims)).astype('float32')
+    vectors = centers[rng.integers(0, len(centers), n)] + 0.6 * rng.normal(size=(n, dims)).astype('float32')
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def _load_vectors(args) -> (np.ndarray, np.ndarray):
+    if args.name:
+        from config import Config
+        from storage import Storage
+
+        embeddings = Storage.create_storage(Config()).get_all_embeddings(args.name)
+        vectors = np.array([e for _, e in embeddings], dtype='float32')
+        rng = np.random.default_rng(1)
+        queries = vectors[rng.integers(0, len(vectors), args.queries)]
+        queries = queries + 0.05 * rng.normal(size=queries.shape).astype('float32')
+        queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+        return vectors, queries
+    vectors = _synthetic_vectors(args.size + args.queries, args.dims)
+    return vectors[:args.size], vectors[args.size:]
+
+
+def bench_index(args):
+    """Recall@k and search latency of the index types against the exact Flat baseline."""
+    vectors, queries = _load_vectors(args)
+    exact = faiss.IndexFlatIP(vectors.shape[1])
+    exact.add(vectors)
+    _, truth = exact.search(queries, args.k)
+
+    print(f"{len(vectors)} vectors, {len(queries)} queries, recall@{args.k}")
+    print(f"{'index':<8} {'build s':>8} {'recall':>8} {'ms/query':>9} {'size MB':>8}")
+    for index_type in args.types:
+        cfg = types.SimpleNamespace(index_type=index_type, index_nlist=args.nlist, index_nprobe=args.nprobe,
+                                    index_pq_m=args.pq_m, index_hnsw_m=args.hnsw_m, index_ef_search=args.ef_search)
+        start = time.perf_counter()
+        index = _create_index(vectors, cfg)
+        index.add_with_ids(vectors, np.arange(len(vectors)))
+        build = time.perf_counter() - start
+
+        found = []
+        start = time.perf_counter()
+        # one query at a time, the way get_texts searches
+        for query in queries:
+            _, ids = index.search(query.reshape(1, -1), args.k)
+            found.append(ids[0])
+        latency = (time.perf_counter() - start) / len(queries) * 1000
+
+        recall = np.mean([len(set(f) & set(t)) / args.k for f, t in zip(found, truth)])
+        size = len(faiss.serialize_index(index)) / 1024 / 1024
+        print(f"{index_type:<8} {build:>8.2f} {recall:>8.3f} {latency:>9.3f} {size:>8.1f}")
+
+
+def bench_pgvector(args):
+    """Search latency of the Postgres storage while the embedding table grows."""
+    from config import Config
+    from storage import Storage
+
+    cfg = Config()
+    if not cfg.use_postgres:
+        raise SystemExit('use_postgres must be enabled in config.json')
+    if args.index_type:
+        cfg.postgres_index_type = args.index_type
+    storage = Storage.create_storage(cfg)
+    rng = np.random.default_rng(0)
+    names = []
+
+    print(f"index {cfg.postgres_index_type}, {args.paragraphs} paragraphs per document, {args.queries} queries")
+    print(f"{'rows':>9} {'documents':>10} {'p50 ms':>8} {'p95 ms':>8}")
+    try:
+        for step in range(args.steps):
+            for _ in range(args.documents):
+                name = f'benchmark-{len(names)}'
+                vectors = _synthetic_vectors(args.paragraphs, 1536, seed=len(names))
+                storage.add_all([(f'paragraph {i}', v.tolist()) for i, v in enumerate(vectors)], name)
+                names.append(name)
+            latencies = []
+            for query in _synthetic_vectors(args.queries, 1536, seed=1000000 + step):
+                name = names[rng.integers(0, len(names))]
+                start = time.perf_counter()
+                storage.get_texts(query.tolist(), name)
+                latencies.append((time.perf_counter() - start) * 1000)
+            print(f"{len(names) * args.paragraphs:>9} {len(names):>10} "
+                  f"{np.percentile(latencies, 50):>8.2f} {np.percentile(latencies, 95):>8.2f}")
+    finally:
+        if not args.keep:
+            for name in names:
+                storage.clear(name)
+
+
+def bench_context(args):
+    """Prompt tokens and completion latency of answers from the whole context window and from packed context."""
+    from ai import AI
+    from config import Config
+    from storage import Storage
+
+    settings = {
+        'window': {'context_max_tokens': 0, 'context_min_score': 0.0, 'context_mmr_lambda': 1.0},
+        'packed': {},
+    }
+    print(f"{len(args.queries)} queries on {args.name}, the completions are requested from the chat model")
+    print(f"{'context':<8} {'limit':>6} {'fragments':>10} {'prompt':>8} {'first s':>8} {'total s':>8}")
+    for setting, overrides in settings.items():
+        cfg = Config()
+        for key, value in overrides.items():
+            setattr(cfg, key, value)
+        ai = AI(cfg)
+        storage = Storage.create_storage(cfg)
+        results = []
+        for query in args.queries:
+            keywords, embedding = ai.get_query_embedding(query)
+            if embedding is None:
+                continue
+            texts = storage.get_texts(embedding, args.name, ai.search_limit, keywords)
+            metrics = {}
+            for _ in ai.completion_stream(query, texts, metrics):
+                pass
+            results.append([metrics['fragments'], metrics['prompt_tokens'],
+                            metrics.get('time_to_first_token', 0), metrics['total_time']])
+        fragments, prompt, first, total = np.mean(results, axis=0)
+        print(f"{setting:<8} {ai.search_limit:>6} {fragments:>10.1f} {prompt:>8.0f} {first:>8.2f} {total:>8.2f}")
+
+
+# packages a module must not load when it is imported, they belong to other modes, storage backends or extractors
+# and are imported on first use
+_STARTUP_EXCLUDED = {
+    'api': ['gradio', 'selenium', 'newspaper', 'readability', 'PyPDF2', 'docx', 'sklearn', 'scipy', 'pandas',
+            'faiss', 'sqlalchemy', 'pgvector'],
+    'console': ['gradio', 'fastapi', 'uvicorn', 'selenium', 'newspaper', 'readability', 'PyPDF2', 'docx', 'sklearn',
+                'scipy', 'pandas', 'faiss', 'sqlalchemy', 'pgvector'],
+    'webui': ['selenium', 'newspaper', 'readability', 'PyPDF2', 'docx', 'sklearn', 'faiss', 'sqlalchemy', 'pgvector'],
+    'storage': ['faiss', 'sqlalchemy', 'pgvector', 'sklearn', 'scipy', 'pandas'],
+    'postgres_storage': ['faiss', 'sklearn', 'scipy', 'pandas'],
+}
+
+_IMPORT_PROBE = """
+import json, resource, sys, time
+before = sorted(sys.modules)
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+# kilobytes on Linux
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({{'seconds': seconds, 'rss': rss, 'before': before, 'modules': sorted(sys.modules)}}))
+"""
+
+
+def _import_times(stderr: str) -> dict:
+    """The cumulative import time in seconds of each top-level package, from the output of -X importtime."""
+    times = {}
+    for line in stderr.splitlines():
+        fields = line.split('|')
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        package = fields[2].strip().split('.')[0]
+        times[package] = max(times.get(package, 0), int(fields[1]) / 1e6)
+    return times
+
+
+def bench_imports(args):
+    """Import time and peak memory of each mode and storage backend in a fresh interpreter, and the packages
+    they load before their first use."""
+    root = os.path.dirname(os.path.abspath(__file__))
+    failed = False
+    print(f"{'module':<17} {'import s':>9} {'RSS MB':>7}  unexpected packages")
+    for module in args.modules:
+        runs = []
+        for _ in range(args.runs):
+            result = subprocess.run([sys.executable, '-X', 'importtime', '-c', _IMPORT_PROBE.format(module=module)],
+                                    cwd=root, capture_output=True, text=True, check=True)
+            runs.append((json.loads(result.stdout.splitlines()[-1]), result.stderr))
+        report, stderr = runs[-1]
+        loaded = {name.split('.')[0] for name in report['modules']}
+        unexpected = [package for package in _STARTUP_EXCLUDED.get(module, []) if package in loaded]
+        failed = failed or bool(unexpected)
+        seconds = np.median([r['seconds'] for r, _ in runs])
+        print(f"{module:<17} {seconds:>9.2f} {report['rss'] / 1024:>7.0f}  {', '.join(unexpected) or '-'}")
+        if args.top:
+            # the packages loaded by the import, not by the interpreter start
+            new = loaded - {name.split('.')[0] for name in report['before']} - {module}
+            times = sorted(((p, t) for p, t in _import_times(stderr).items() if p in new), key=lambda item: -item[1])
+            print('    ' + ', '.join(f'{package} {t:.2f}s' for package, t in times[:args.top]))
+    if args.check and failed:
+        raise SystemExit('a module loads packages that should only be imported on first use')
+
+
+def _sif_reference(paragraph_list) -> list[float]:
+    """The word by word SIF loop that AI._calc_paragraph_avg_embedding_with_sif replaced."""
+    from sklearn.feature_extraction.text import TfidfVectorizer
+
+    alpha = 0.001
+    n_sentences = len(paragraph_list)
+    n_dims = len(paragraph_list[0][1])
+    vectorizer = TfidfVectorizer(use_idf=True)
+    vectorizer.fit_transform([paragraph for paragraph, _ in paragraph_list])
+    idf = vectorizer.idf_
+    weights = np.zeros((n_sentences, n_dims))
+    for i, (sentence, embedding) in enumerate(paragraph_list):
+        for word in sentence.split():
+            try:
+                word_weight = alpha / (alpha + idf[vectorizer.vocabulary_[word]])
+                weights[i] += word_weight * (np.array(embedding) / np.max(embedding))
+            except KeyError:
+                pass
+    avg_embedding = np.zeros(n_dims)
+    for i, (sentence, embedding) in enumerate(paragraph_list):
+        avg_embedding += (np.array(embedding) / np.max(embedding)) - weights[i]
+    avg_embedding /= n_sentences
+    return avg_embedding.tolist()
+
+
+def bench_sif(args):
+    """Equivalence and speedup of the vectorized SIF average embedding against the word by word loop."""
+    from ai import AI
+
+    rng = np.random.default_rng(0)
+    # a zipf distributed vocabulary with capitalized and punctuated variants, which the lookup treats as
+    # different words
+    words = [f'word{i}' for i in range(args.vocabulary)]
+    words += [w.capitalize() for w in words[:100]] + [w + ',' for w in words[:100]]
+    frequencies = 1 / np.arange(1, len(words) + 1)
+    frequencies /= frequencies.sum()
+
+    print(f"{'paragraphs':>10} {'loop s':>8} {'vector s':>9} {'speedup':>8} {'max diff':>9}")
+    for size in args.sizes:
+        vectors = _synthetic_vectors(size, args.dims, seed=size)
+        paragraphs = [' '.join(rng.choice(words, rng.integers(5, 2 * args.words), p=frequencies))
+                      for _ in range(size)]
+        paragraph_list = list(zip(paragraphs, vectors.tolist()))
+
+        start = time.perf_counter()
+        expected = np.array(_sif_reference(paragraph_list))
+        loop = time.perf_counter() - start
+        start = time.perf_counter()
+        actual = np.array(AI._calc_paragraph_avg_embedding_with_sif(paragraph_list))
+        vector = time.perf_counter() - start
+
+        diff = np.max(np.abs(actual - expected))
+        if not np.allclose(actual, expected, rtol=1e-9, atol=1e-9):
+            raise SystemExit(f"the vectorized SIF differs from the loop by {diff}")
+        print(f"{size:>10} {loop:>8.3f} {vector:>9.4f} {loop / vector:>7.0f}x {diff:>9.1e}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    index_parser = subparsers.add_parser('index', help=bench_index.__doc__)
+    index_parser.add_argument('--name', help='benchmark the embeddings of an indexed document instead of '
+                                             'synthetic vectors')
+    index_parser.add_argument('--size', type=int, default=20000, help='number of synthetic vectors')
+    index_parser.add_argument('--dims', type=int, default=1536)
+    index_parser.add_argument('--queries', type=int, default=200)
+    index_parser.add_argument('--k', type=int, default=10)
+    index_parser.add_argument('--types', nargs='+', default=['Flat', 'HNSW', 'IVF', 'IVFPQ', 'IVFSQ8'])
+    index_parser.add_argument('--nlist', type=int, default=0)
+    index_parser.add_argument('--nprobe', type=int, default=16)
+    index_parser.add_argument('--pq-m', type=int, default=64)
+    index_parser.add_argument('--hnsw-m', type=int, default=32)
+    index_parser.add_argument('--ef-search', type=int, default=128)
+    index_parser.set_defaults(func=bench_index)
+
+    sif_parser = subparsers.add_parser('sif', help=bench_sif.__doc__)
+    sif_parser.add_argument('--sizes', type=int, nargs='+', default=[100, 500, 2000])
+    sif_parser.add_argument('--dims', type=int, default=1536)
+    sif_parser.add_argument('--vocabulary', type=int, default=5000)
+    sif_parser.add_argument('--words', type=int, default=40, help='average words per paragraph')
+    sif_parser.set_defaults(func=bench_sif)
+
+    pgvector_parser = subparsers.add_parser('pgvector', help=bench_pgvector.__doc__)
+    pgvector_parser.add_argument('--index-type', choices=['hnsw', 'ivfflat', 'none'],
+                                 help='override postgres_index_type of config.json')
+    pgvector_parser.add_argument('--steps', type=int, default=5)
+    pgvector_parser.add_argument('--documents', type=int, default=20, help='documents added per step')
+    pgvector_parser.add_argument('--paragraphs', type=int, default=500, help='paragraphs per document')
+    pgvector_parser.add_argument('--queries', type=int, default=100)
+    pgvector_parser.add_argument('--keep', action='store_true', help='keep the benchmark documents')
+    pgvector_parser.set_defaults(func=bench_pgvector)
+
+    imports_parser = subparsers.add_parser('imports', help=bench_imports.__doc__)
+    imports_parser.add_argument('--modules', nargs='+', default=list(_STARTUP_EXCLUDED))
+    imports_parser.add_argument('--runs', type=int, default=3, help='the import time is the median of the runs')
+    imports_parser.add_argument('--top', type=int, default=5, help='show the slowest packages of each module')
+    imports_parser.add_argument('--check', action='store_true',
+                                help='exit with an error if a module loads a package it should not')
+    imports_parser.set_defaults(func=bench_imports)
+
+    context_parser = subparsers.add_parser('context', help=bench_context.__doc__)
+    context_parser.add_argument('--name', required=True, help='the hash id of an indexed document')
+    context_parser.add_argument('--queries', nargs='+', required=True, help='questions about the document')
+    context_parser.set_defaults(func=bench_context)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
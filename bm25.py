@@ -0,0 +1,93 @@
+import re
+
+import numpy as np
+
+# CJK text has no spaces, each character is a term, other text is split into runs of word characters
+_CJK = '\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af'
+_TERM = re.compile(f'[{_CJK}]|[^\\W{_CJK}]+')
+
+
+def tokenize(text: str) -> list[str]:
+    """The terms of the text, lowercased."""
+    return _TERM.findall(text.lower())
+
+
+def reciprocal_rank_fusion(rankings: list[list[int]], limit: int, k: int = 60) -> list[int]:
+    """Merge rankings of ids by the sum of 1 / (k + rank) over the rankings an id appears in."""
+    scores = {}
+    for ranking in rankings:
+        for rank, i in enumerate(ranking, 1):
+            scores[i] = scores.get(i, 0) + 1 / (k + rank)
+    # ties keep the order of the first ranking
+    return sorted(scores, key=scores.get, reverse=True)[:limit]
+
+
+class BM25Index:
+    """An Okapi BM25 inverted index over the paragraphs of a document.
+
+    The BM25 weight of every term in every paragraph is computed when the index is built and kept as a sparse
+    matrix with a row per term, so a search sums the rows of the query terms.
+    """
+
+    def __init__(self, vocabulary: dict, weights: 'sparse.csr_matrix', count: int):
+        self._vocabulary = vocabulary
+        self._weights = weights
+        self.count = count
+
+    @classmethod
+    def build(cls, texts: list[str], k1: float = 1.5, b: float = 0.75) -> 'BM25Index':
+        """Build the index of the texts."""
+        from scipy import sparse
+        from sklearn.feature_extraction.text import CountVectorizer
+
+        if not texts:
+            return cls({}, sparse.csr_matrix((0, 0), dtype='float32'), 0)
+        vectorizer = CountVectorizer(tokenizer=tokenize, lowercase=False, token_pattern=None, dtype=np.float32)
+        try:
+            counts = vectorizer.fit_transform(texts).tocsr()
+        except ValueError:
+            # none of the texts has a term
+            return cls({}, sparse.csr_matrix((0, len(texts)), dtype='float32'), len(texts))
+        lengths = np.asarray(counts.sum(axis=1)).ravel()
+        df = np.bincount(counts.indices, minlength=counts.shape[1])
+        idf = np.log(1 + (len(texts) - df + 0.5) / (df + 0.5)).astype('float32')
+        # tf * (k1 + 1) / (tf + k1 * (1 - b + b * length / average length)) for the non-zero counts
+        norms = k1 * (1 - b + b * lengths / max(lengths.mean(), 1))
+        tf = counts.data
+        counts.data = idf[counts.indices] * tf * (k1 + 1) / (tf + np.repeat(norms, np.diff(counts.indptr)))
+        vocabulary = {term: int(i) for term, i in vectorizer.vocabulary_.items()}
+        return cls(vocabulary, counts.T.tocsr().astype('float32'), len(texts))
+
+    @classmethod
+    def read(cls, f) -> 'BM25Index':
+        """Read the index from a file written by write."""
+        from scipy import sparse
+
+        with np.load(f) as data:
+            terms = data['terms'].tobytes().decode('utf-8')
+            vocabulary = {term: i for i, term in enumerate(terms.split('\n'))} if terms else {}
+            weights = sparse.csr_matrix((data['data'], data['indices'], data['indptr']), shape=tuple(data['shape']))
+            return cls(vocabulary, weights, int(data['count']))
+
+    def write(self, f):
+        """Write the index to a file."""
+        terms = sorted(self._vocabulary, key=self._vocabulary.get)
+        np.savez(f, terms=np.frombuffer('\n'.join(terms).encode('utf-8'), dtype='uint8'), data=self._weights.data,
+                 indices=self._weights.indices, indptr=self._weights.indptr, shape=np.array(self._weights.shape),
+                 count=np.array(self.count))
+
+    def search(self, query: str, limit: int) -> list[tuple[int, float]]:
+        """The ids and scores of the paragraphs that contain terms of the query, the highest score first."""
+        rows = [self._vocabulary[term] for term in dict.fromkeys(tokenize(query)) if term in self._vocabulary]
+        if not rows:
+            return []
+        scores = np.asarray(self._weights[rows].sum(axis=0)).ravel()
+        found = np.flatnonzero(scores)
+        if len(found) > limit:
+            found = found[np.argpartition(-scores[found], limit - 1)[:limit]]
+        found = found[np.argsort(-scores[found], kind='stable')]
+        return [(int(i), float(scores[i])) for i in found]
+
+    @property
+    def nbytes(self) -> int:
+        return self._weights.data.nbytes + self._weights.indices.nbytes + self._weights.indptr.nbytes
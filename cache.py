@@ -0,0 +1,83 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+import xxhash
+
+
+class EmbeddingCache:
+    """A persistent cache of paragraph embeddings, keyed by model, dimensions and text hash."""
+
+    # sqlite limits the number of host parameters in one statement
+    _BATCH_SIZE = 500
+
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS embedding (key TEXT PRIMARY KEY, embedding BLOB NOT NULL)')
+        self._conn.commit()
+
+    @staticmethod
+    def key(model: str, dimensions: int, text: str) -> str:
+        """Get the cache key of the text."""
+        return f'{model}:{dimensions}:{xxhash.xxh3_128_hexdigest(text.encode("utf-8"))}'
+
+    def get_many(self, keys: list[str]) -> dict[str, list[float]]:
+        """Get the cached embeddings of the keys, missing keys are left out."""
+        result = {}
+        unique_keys = list(dict.fromkeys(keys))
+        with self._lock:
+            for i in range(0, len(unique_keys), self._BATCH_SIZE):
+                batch = unique_keys[i:i + self._BATCH_SIZE]
+                rows = self._conn.execute(
+                    f'SELECT key, embedding FROM embedding WHERE key IN ({",".join("?" * len(batch))})', batch)
+                for key, blob in rows:
+                    result[key] = np.frombuffer(blob, dtype='<f4').tolist()
+        return result
+
+    def put_many(self, items: dict[str, list[float]]):
+        """Cache the embeddings."""
+        rows = [(key, np.asarray(embedding, dtype='<f4').tobytes()) for key, embedding in items.items()]
+        with self._lock:
+            self._conn.executemany('INSERT OR REPLACE INTO embedding (key, embedding) VALUES (?, ?)', rows)
+            self._conn.commit()
+
+
+class TTLCache:
+    """A thread-safe LRU cache whose entries expire after ttl seconds."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Get the value of the key, or None if it is missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        """Cache the value of the key."""
+        if self._maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self._ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
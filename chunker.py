@@ -0,0 +1,142 @@
+import re
+from typing import Iterable, Iterator, Optional
+
+import numpy as np
+
+# a sentence ends with one of these, followed by a space or, for CJK punctuation, directly by the next one, the
+# separator is captured so that the sentences are joined again as they were
+_SENTENCE_SPLIT = re.compile(r'((?<=[.!?;])\s+|(?<=[。！？；…])\s*)')
+_SENTENCE_ENDINGS = ('.', '!', '?', ';', ':', '。', '！', '？', '；', '：', '…',
+                     '"', "'", '”', '’', ')', '）')
+# a short paragraph that does not end like a sentence is taken for a heading
+_HEADING_TOKENS = 16
+
+
+class Fragment(str):
+    """A text with its number of tokens, None when it is not known, the label it is prefixed with and, for a
+    search result, its similarity to the query.
+
+    Chunks are tokenized once when they are made, the count is stored with them and read back by the storage,
+    so that the context of a query is packed without tokenizing it again. The count does not include the label.
+    """
+
+    tokens: Optional[int]
+    label: str
+    score: Optional[float]
+
+    def __new__(cls, text: str, tokens: Optional[int] = None, label: str = '', score: Optional[float] = None):
+        fragment = super().__new__(cls, label + text)
+        fragment.tokens = tokens
+        fragment.label = label
+        fragment.score = score
+        return fragment
+
+
+def num_tokens(text: str) -> Optional[int]:
+    """The number of tokens of the text, without its label, if it is a fragment that knows it."""
+    return getattr(text, 'tokens', None)
+
+
+class Chunker:
+    """Merge and split extracted paragraphs into chunks of about chunk_tokens tokens.
+
+    Paragraphs are kept whole when they fit, longer ones are split at sentence ends, and a chunk is closed
+    before a heading once it is half full. Consecutive chunks share up to overlap_tokens tokens of whole
+    sentences. Every paragraph is tokenized once, the token count of a chunk is the sum of its parts.
+    """
+
+    def __init__(self, encoding, chunk_tokens: int = 300, overlap_tokens: int = 30):
+        self._encoding = encoding
+        self._chunk_tokens = chunk_tokens
+        self._overlap_tokens = overlap_tokens
+
+    def chunk(self, paragraphs: Iterable[str]) -> list[Fragment]:
+        """The chunks of the paragraphs."""
+        return list(self.iter_chunks(paragraphs))
+
+    def iter_chunks(self, paragraphs: Iterable[str]) -> Iterator[Fragment]:
+        """Yield the chunks of the paragraphs with their token counts, as soon as each one is complete."""
+        if self._chunk_tokens <= 0:
+            for paragraph in paragraphs:
+                yield Fragment(paragraph, self._count(paragraph))
+            return
+
+        units = []
+        for paragraph in paragraphs:
+            for unit in self._units(paragraph):
+                text, tokens, starts_paragraph, _ = unit
+                heading = starts_paragraph and self._is_heading(text, tokens)
+                size = self._size(units)
+                if units and (size + 1 + tokens > self._chunk_tokens or heading and size >= self._chunk_tokens // 2):
+                    yield self._join(units)
+                    # a new section does not start with the end of the previous one
+                    units = [] if heading else self._overlap(units)
+                    if self._size(units) + 1 + tokens > self._chunk_tokens:
+                        units = []
+                units.append(unit)
+        if units:
+            yield self._join(units)
+
+    @staticmethod
+    def stats(token_counts: list[int]) -> dict:
+        """The number of chunks and the distribution of their sizes in tokens."""
+        if not token_counts:
+            return {'chunks': 0, 'tokens': 0}
+        counts = np.array(token_counts)
+        return {'chunks': len(counts), 'tokens': int(counts.sum()), 'min': int(counts.min()),
+                'p50': int(np.percentile(counts, 50)), 'p90': int(np.percentile(counts, 90)),
+                'max': int(counts.max())}
+
+    def _count(self, text: str) -> int:
+        return len(self._encoding.encode(text))
+
+    def _units(self, paragraph: str) -> Iterator[tuple[str, int, bool, str]]:
+        """The paragraph, or its sentences if it does not fit in a chunk, with their tokens, whether they
+        start the paragraph and the separator in front of them in the paragraph."""
+        tokens = self._count(paragraph)
+        if tokens <= self._chunk_tokens:
+            yield paragraph, tokens, True, '\n'
+            return
+        first = True
+        parts = _SENTENCE_SPLIT.split(paragraph)
+        # the sentences are at the even positions, each preceded by its separator
+        for i in range(0, len(parts), 2):
+            sentence = parts[i]
+            separator = parts[i - 1] if i else '\n'
+            if not sentence:
+                continue
+            tokens = self._count(sentence)
+            if tokens <= self._chunk_tokens:
+                yield sentence, tokens, first, separator
+            else:
+                # a sentence longer than a chunk is cut by characters, in proportion to its tokens
+                pieces = -(-tokens // self._chunk_tokens)
+                step = -(-len(sentence) // pieces)
+                for start in range(0, len(sentence), step):
+                    piece = sentence[start:start + step]
+                    yield piece, self._count(piece), first, separator if start == 0 else ''
+                    first = False
+            first = False
+
+    @staticmethod
+    def _is_heading(text: str, tokens: int) -> bool:
+        return tokens <= _HEADING_TOKENS and not text.rstrip().endswith(_SENTENCE_ENDINGS)
+
+    @staticmethod
+    def _size(units: list[tuple[str, int, bool, str]]) -> int:
+        # one token for each separator that is not empty, a chunk starts with its first unit
+        return sum(tokens for _, tokens, _, _ in units) + sum(1 for unit in units[1:] if unit[2] or unit[3])
+
+    def _overlap(self, units: list[tuple[str, int, bool, str]]) -> list[tuple[str, int, bool, str]]:
+        overlap = []
+        for unit in reversed(units):
+            if self._size([unit] + overlap) > self._overlap_tokens:
+                break
+            overlap.insert(0, unit)
+        return overlap
+
+    def _join(self, units: list[tuple[str, int, bool, str]]) -> Fragment:
+        text = units[0][0]
+        for unit_text, _, starts_paragraph, separator in units[1:]:
+            text += ('\n' if starts_paragraph else separator) + unit_text
+        return Fragment(text, self._size(units))
@@ -61,6 +61,8 @@ class Config:
             self.language = self.config.get('language', 'Chinese')
             self.open_ai_key = self.config.get('open_ai_key')
             self.open_ai_proxy = self.config.get('open_ai_proxy')
+            # an OpenAI compatible endpoint, e.g. a local stub for testing
+            self.open_ai_base_url = self.config.get('open_ai_base_url')
             gpt_model = self.config.get('open_ai_chat_model', 'gpt-3.5-turbo')
             self.open_ai_chat_model = self.get_gpt_model(gpt_model)
             embedding_model = self.config.get('open_ai_embedding_model', 'text-embedding-ada-002')
@@ -72,18 +74,92 @@ class Config:
                 raise ValueError(
                     'temperature must be between 0 and 1, less is more conservative, more is more creative')
             self.use_stream = self.config.get('use_stream', False)
+            self.embedding_concurrency = self.config.get('embedding_concurrency', 4)
+            if self.embedding_concurrency < 1:
+                raise ValueError('embedding_concurrency must be at least 1')
+            self.embedding_tokens_per_minute = self.config.get('embedding_tokens_per_minute', 0)
+            self.embedding_max_retries = self.config.get('embedding_max_retries', 5)
+            # set to an empty string to disable the cache
+            self.embedding_cache_path = self.config.get('embedding_cache_path', './cache/embeddings.db')
+            # paragraphs are merged and split into chunks of about this many tokens before embedding, 0 embeds
+            # the extracted paragraphs as they are
+            self.chunk_tokens = self.config.get('chunk_tokens', 300)
+            self.chunk_overlap_tokens = self.config.get('chunk_overlap_tokens', 30)
+            # search with the keywords extracted from the query, or with the query itself
+            self.use_keywords = self.config.get('use_keywords', True)
+            self.query_cache_size = self.config.get('query_cache_size', 1024)
+            self.query_cache_ttl = self.config.get('query_cache_ttl', 3600)
+            # fuse the vector search with a full-text search of the keywords, BM25 with FAISS and the full-text search
+            # of PostgreSQL, by reciprocal rank with this k
+            self.hybrid_search = self.config.get('hybrid_search', True)
+            self.hybrid_rrf_k = self.config.get('hybrid_rrf_k', 60)
+            # the prompt of an answer holds at most this many tokens of search results, 0 fills the context window,
+            # results scored below the minimum similarity are left out and mmr_lambda below 1 prefers diverse ones
+            self.context_max_tokens = self.config.get('context_max_tokens', 4000)
+            self.context_min_score = self.config.get('context_min_score', 0.0)
+            self.context_mmr_lambda = self.config.get('context_mmr_lambda', 0.7)
+            if not 0 <= self.context_mmr_lambda <= 1:
+                raise ValueError('context_mmr_lambda must be between 0 and 1')
             self.use_postgres = self.config.get('use_postgres', False)
             if not self.use_postgres:
                 self.index_path = self.config.get('index_path', './temp')
                 os.makedirs(self.index_path, exist_ok=True)
+            self.index_cache_mb = self.config.get('index_cache_mb', 1024)
+            self.index_compact_threshold = self.config.get('index_compact_threshold', 10000)
+            # read indexes through mmap, so that the processes of the API share one copy in the page cache
+            self.index_mmap = self.config.get('index_mmap', True)
+            # Flat is exact, HNSW and IVF are approximate, IVFPQ and IVFSQ8 also compress the vectors
+            self.index_type = self.config.get('index_type', 'Flat')
+            if self.index_type not in ['Flat', 'HNSW', 'IVF', 'IVFPQ', 'IVFSQ8']:
+                raise ValueError('index_type must be Flat, HNSW, IVF, IVFPQ or IVFSQ8')
+            # 0 picks 4 * sqrt(number of vectors) IVF lists
+            self.index_nlist = self.config.get('index_nlist', 0)
+            self.index_nprobe = self.config.get('index_nprobe', 16)
+            self.index_pq_m = self.config.get('index_pq_m', 64)
+            self.index_hnsw_m = self.config.get('index_hnsw_m', 32)
+            self.index_ef_search = self.config.get('index_ef_search', 128)
             self.postgres_url = self.config.get('postgres_url')
             if self.use_postgres and self.postgres_url is None:
                 raise ValueError('postgres_url is not set')
+            self.postgres_pool_size = self.config.get('postgres_pool_size', 10)
+            self.postgres_max_overflow = self.config.get('postgres_max_overflow', 20)
+            # the vector index of the embedding table, hnsw, ivfflat or none
+            self.postgres_index_type = self.config.get('postgres_index_type', 'hnsw')
+            if self.postgres_index_type not in ['hnsw', 'ivfflat', 'none']:
+                raise ValueError('postgres_index_type must be hnsw, ivfflat or none')
+            self.postgres_hnsw_m = self.config.get('postgres_hnsw_m', 16)
+            self.postgres_hnsw_ef_construction = self.config.get('postgres_hnsw_ef_construction', 64)
+            self.postgres_ef_search = self.config.get('postgres_ef_search', 100)
+            self.postgres_probes = self.config.get('postgres_probes', 10)
             self.mode = self.config.get('mode', 'webui')
             if self.mode not in ['console', 'api', 'webui']:
                 raise ValueError('mode must be console or api or webui')
             self.api_port = self.config.get('api_port', 9531)
             self.api_host = self.config.get('api_host', 'localhost')
+            # processes serving the API, each with its own executors, they share the index files
+            self.api_workers = self.config.get('api_workers', 1)
+            if self.api_workers < 1:
+                raise ValueError('api_workers must be at least 1')
+            # threads for blocking work of the API, such as parsing files and searching indexes
+            self.api_executor_workers = self.config.get('api_executor_workers', 8)
+            # threads for crawling web pages with Chrome, each one runs a browser
+            self.api_crawler_workers = self.config.get('api_crawler_workers', 2)
+            # the keyword and completion requests in flight for one /answer_batch request
+            self.api_batch_concurrency = self.config.get('api_batch_concurrency', 8)
+            # run /crawler_url and /upload_file as background jobs that return a job id, on api_job_workers threads
+            # with at most api_job_queue_size jobs waiting for one
+            self.api_job_queue = self.config.get('api_job_queue', False)
+            self.api_job_workers = self.config.get('api_job_workers', 2)
+            self.api_job_queue_size = self.config.get('api_job_queue_size', 64)
+            self.job_state_path = self.config.get('job_state_path', './cache/jobs.db')
+            # bulk ingestion, the threads of each pipeline stage and the URLs waiting in front of each stage
+            self.ingest_state_path = self.config.get('ingest_state_path', './cache/ingest.db')
+            self.ingest_crawl_workers = self.config.get('ingest_crawl_workers', 4)
+            self.ingest_embed_workers = self.config.get('ingest_embed_workers', 2)
+            self.ingest_store_workers = self.config.get('ingest_store_workers', 1)
+            self.ingest_queue_size = self.config.get('ingest_queue_size', 16)
+            # processes extracting the pages of a PDF, 1 extracts them in the calling thread
+            self.pdf_workers = self.config.get('pdf_workers', 4)
             self.webui_port = self.config.get('webui_port', 7860)
             self.webui_host = self.config.get('webui_host', '0.0.0.0')
 
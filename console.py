@@ -1,7 +1,6 @@
-import xxhash
-
 from ai import AI
 from config import Config
+from ingest import get_hash_id, chunk_contents, index_summary, summary_candidates, get_summary, set_summary
 from storage import Storage
 from contents import *
 
@@ -18,7 +17,7 @@ def console(cfg: Config):
 def _console(cfg: Config) -> bool:
     """Run the console."""
 
-    contents, lang, identify = _get_contents()
+    contents, lang, identify = _get_contents(cfg)
 
     print("The article has been retrieved, and the number of text fragments is:", len(contents))
     for content in contents:
@@ -34,11 +33,12 @@ def _console(cfg: Config) -> bool:
     else:
         # 1. 对文章的每个段落生成embedding
         # 1. Generate an embedding for each paragraph of the article.
-        embeddings, tokens = ai.create_embeddings(contents)
+        embeddings, tokens = ai.create_embeddings(chunk_contents(ai, contents))
         print(f"Embeddings have been created with {len(embeddings)} embeddings, using {tokens} tokens, "
               f"costing ${tokens / 1000 * 0.0004}")
 
         storage.add_all(embeddings, identify)
+        index_summary(ai, storage, embeddings, identify, lang)
         print("The embeddings have been saved.")
         print("=====================================")
 
@@ -53,17 +53,23 @@ def _console(cfg: Config) -> bool:
             elif query == "/summary":
                 # 生成embedding式摘要，根据不同的语言使用有基于SIF的加权平均或一般的直接求平均
                 # Generate an embedding-based summary, using weighted average based on SIF or direct average based on the language.
-                ai.generate_summary(storage.get_all_embeddings(identify), num_candidates=100,
-                                    use_sif=lang not in ['zh', 'ja', 'ko', 'hi', 'ar', 'fa'])
+                # the candidates are ranked at indexing, and the summary is generated once
+                summary = get_summary(ai, storage, identify)
+                if summary is not None:
+                    print(summary)
+                else:
+                    summary = ai.generate_summary(summary_candidates(ai, storage, identify, lang))
+                    set_summary(ai, storage, identify, summary)
             elif query == "/reindex":
                 # 重新索引，会清空数据库
                 # Re-index, which will clear the database.
                 storage.clear(identify)
-                embeddings, tokens = ai.create_embeddings(contents)
+                embeddings, tokens = ai.create_embeddings(chunk_contents(ai, contents))
                 print(f"Embeddings have been created with {len(embeddings)} embeddings, using {tokens} tokens, "
                       f"costing ${tokens / 1000 * 0.0004}")
 
                 storage.add_all(embeddings, identify)
+                index_summary(ai, storage, embeddings, identify, lang)
                 print("The embeddings have been saved.")
             elif query == "/help":
                 print("Enter /summary to generate an embedding-based summary.")
@@ -81,26 +87,25 @@ def _console(cfg: Config) -> bool:
             print("=====================================")
             continue
         else:
-            # 1. 生成关键词
-            # 1. Generate keywords.
+            # 1. 生成关键词，并对关键词生成embedding
+            # 1. Generate keywords, and an embedding for the keywords.
             print("Generate keywords.")
-            keywords = ai.get_keywords(query)
-            # 2. 对问题生成embedding
-            # 2. Generate an embedding for the question.
-            _, embedding = ai.create_embedding(keywords)
-            # 3. 从数据库中找到最相似的片段
-            # 3. Find the most similar fragments from the database.
-            texts = storage.get_texts(embedding, identify)
+            keywords, embedding = ai.get_query_embedding(query)
+            if embedding is None:
+                continue
+            # 2. 从数据库中找到最相似的片段
+            # 2. Find the most similar fragments from the database.
+            texts = storage.get_texts(embedding, identify, ai.search_limit, keywords)
             print("Related fragments found (first 5):")
             for text in texts[:5]:
                 print('\t', text)
-            # 4. 把相关片段推给AI，AI会根据这些片段回答问题
-            # 4. Push the relevant fragments to the AI, which will answer the question based on these fragments.
+            # 3. 把相关片段推给AI，AI会根据这些片段回答问题
+            # 3. Push the relevant fragments to the AI, which will answer the question based on these fragments.
             ai.completion(query, texts)
             print("=====================================")
 
 
-def _get_contents() -> tuple[list[str], str, str]:
+def _get_contents(cfg: Config) -> tuple[list[str], str, str]:
     """Get the contents."""
 
     while True:
@@ -108,7 +113,7 @@ def _get_contents() -> tuple[list[str], str, str]:
             url = input("Please enter the link to the article or the file path of the PDF/TXT/DOCX document: ").strip()
             if os.path.exists(url):
                 if url.endswith('.pdf'):
-                    contents, data = extract_text_from_pdf(url)
+                    contents, data = extract_text_from_pdf(url, cfg.pdf_workers)
                 elif url.endswith('.txt'):
                     contents, data = extract_text_from_txt(url)
                 elif url.endswith('.docx'):
@@ -122,6 +127,6 @@ def _get_contents() -> tuple[list[str], str, str]:
                 print("Unable to retrieve the content of the article. Please enter the link to the article or "
                       "the file path of the PDF/TXT/DOCX document again.")
                 continue
-            return contents, data, xxhash.xxh3_128_hexdigest('\n'.join(contents))
+            return contents, data, get_hash_id(contents)
         except Exception as e:
             print("Error:", e)
@@ -1,16 +1,26 @@
+import atexit
+import multiprocessing
 import os
+import queue
+import threading
 import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 
-import PyPDF2
-import docx
-import readability
+import lxml.html
+from lxml import etree
+import requests
 from langdetect import detect
-from newspaper import fulltext, Article
-from selenium import webdriver
+
+# the crawler and the extractors import newspaper, readability, selenium, PyPDF2 and docx when they first run, so
+# that each mode only loads what it uses
 
 
 def web_crawler_newspaper(url: str) -> tuple[list[str], str]:
     """Run the web crawler."""
+    from newspaper import fulltext, Article
+
     raw_html, lang = _get_raw_html(url)
     try:
         text = fulltext(raw_html, language=lang)
@@ -23,59 +33,264 @@ def web_crawler_newspaper(url: str) -> tuple[list[str], str]:
     return contents, lang
 
 
+_USER_AGENT = ('Mozilla/5.0 (Windows NT 10.0; Win64; x64) '
+               'AppleWebKit/537.36 (KHTML, like Gecko) Chrome/112.0.0.0 Safari/537.36')
+# pages with less text than this after readability are rendered with Chrome, they are probably built by scripts
+_MIN_STATIC_TEXT = 500
+# the longest wait for a page to finish loading and go quiet, and how long without new requests is quiet
+_READY_TIMEOUT = 10
+_NETWORK_IDLE = 0.5
+# a browser is restarted after this many pages, long-lived Chrome processes keep growing
+_CHROME_MAX_PAGES = 100
+# a line ending with one of these ends a paragraph of a PDF
+_SENTENCE_ENDINGS = ['.', '!', '?', '。', '！', '？', '…', ';', '；', ':', '：', '”', '’', '）', '】', '》', '」', '』', '〕',
+                     '〉', '》', '〗', '〞', '〟', '»', '"', "'", ')', ']', '}']
+# the pages of a PDF extracted by one task
+_PDF_PAGES_PER_TASK = 16
+# starting the processes takes about a second, smaller PDFs are extracted in the calling thread
+_PDF_MIN_POOL_PAGES = 100
+# the characters the language is detected from
+_LANGUAGE_SAMPLE = 10000
+
+
 def _get_raw_html(url):
+    import readability
+
+    # static pages are fetched directly, Chrome only renders the pages that need scripts
+    html = _fetch_html(url)
+    summary = readability.Document(html).summary() if html else ''
+    if _text_length(summary) < _MIN_STATIC_TEXT:
+        summary = readability.Document(_render_html(url)).summary()
+    lang = detect(summary)
+    return summary, lang[0:2]
+
+
+def _text_length(html) -> int:
+    try:
+        return len(lxml.html.fromstring(html).text_content().strip())
+    except (etree.ParserError, ValueError):
+        return 0
+
+
+def _fetch_html(url):
+    """Fetch the page without a browser, None if it can not be fetched this way."""
+    try:
+        response = requests.get(url, headers={'User-Agent': _USER_AGENT}, timeout=_READY_TIMEOUT)
+        response.raise_for_status()
+    except requests.RequestException as e:
+        print(f"Fetching {url} failed ({e}), rendering it with Chrome")
+        return None
+    content_type = response.headers.get('Content-Type', 'text/html')
+    if 'html' not in content_type:
+        return None
+    # without a charset in the header requests decodes as ISO-8859-1, the bytes let readability find the charset
+    # of the <meta> tag
+    return response.text if 'charset' in content_type.lower() else response.content
+
+
+def _render_html(url):
+    """Load the page in a pooled Chrome, once it is ready and the network has gone quiet."""
+    with _get_chrome_pool().driver() as driver:
+        driver.get(url)
+        _wait_until_ready(driver)
+        return driver.page_source
+
+
+def _wait_until_ready(driver):
+    from selenium.common.exceptions import TimeoutException
+    from selenium.webdriver.support.ui import WebDriverWait
+
+    try:
+        WebDriverWait(driver, _READY_TIMEOUT).until(
+            lambda d: d.execute_script('return document.readyState') == 'complete')
+    except TimeoutException:
+        print("The webpage did not finish loading, using what has been loaded.")
+        return
+    # the network is idle when no resource has been requested for a while, scripts may still be loading content
+    deadline = time.monotonic() + _READY_TIMEOUT
+    count, since = -1, time.monotonic()
+    while time.monotonic() < deadline:
+        loaded = driver.execute_script("return performance.getEntriesByType('resource').length")
+        if loaded != count:
+            count, since = loaded, time.monotonic()
+        elif time.monotonic() - since >= _NETWORK_IDLE:
+            return
+        time.sleep(0.1)
+
+
+def _new_chrome():
+    from selenium import webdriver
+
     chrome_options = webdriver.ChromeOptions()
     chrome_options.add_argument('--headless')
     chrome_options.add_argument('--disable-gpu')
     chrome_options.add_argument('--no-sandbox')
     chrome_options.add_argument('--disable-dev-shm-usage')
-    chrome_options.add_argument('--user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) '
-                                'AppleWebKit/537.36 (KHTML, like Gecko) Chrome/112.0.0.0 Safari/537.36')
+    chrome_options.add_argument(f'--user-agent={_USER_AGENT}')
+    driver = webdriver.Chrome(options=chrome_options)
+    driver.set_page_load_timeout(_READY_TIMEOUT * 3)
+    return driver
 
-    with webdriver.Chrome(options=chrome_options) as driver:
-        driver.get(url)
-        print("Please wait for 5 seconds until the webpage finishes loading.")
-        time.sleep(5)
-        html = driver.page_source
 
-    doc = readability.Document(html)
-    html = doc.summary()
-    lang = detect(html)
-    return html, lang[0:2]
+class _ChromePool:
+    """A bounded pool of warm Chrome instances, started on demand and reused across pages."""
+
+    def __init__(self, size: int):
+        self._semaphore = threading.BoundedSemaphore(size)
+        self._idle = queue.LifoQueue()
+        self._pages = {}
+
+    @contextmanager
+    def driver(self):
+        with self._semaphore:
+            try:
+                driver = self._idle.get_nowait()
+            except queue.Empty:
+                driver = _new_chrome()
+                self._pages[driver] = 0
+            reuse = False
+            try:
+                yield driver
+                self._pages[driver] += 1
+                # the next page must not see the cookies of this one
+                driver.delete_all_cookies()
+                driver.get('about:blank')
+                reuse = self._pages[driver] < _CHROME_MAX_PAGES
+            finally:
+                if reuse:
+                    self._idle.put(driver)
+                else:
+                    self._quit(driver)
 
+    def close(self):
+        while True:
+            try:
+                self._quit(self._idle.get_nowait())
+            except queue.Empty:
+                return
 
-def extract_text_from_pdf(file_path: str) -> tuple[list[str], str]:
+    def _quit(self, driver):
+        from selenium.common.exceptions import WebDriverException
+
+        self._pages.pop(driver, None)
+        try:
+            driver.quit()
+        except WebDriverException:
+            pass
+
+
+_chrome_pool = None
+_chrome_pool_size = 2
+_chrome_pool_lock = threading.Lock()
+
+
+def set_chrome_pool_size(size: int):
+    """Set the number of Chrome instances kept for crawling, before the first page is rendered."""
+    global _chrome_pool_size
+    _chrome_pool_size = size
+
+
+def _get_chrome_pool() -> _ChromePool:
+    global _chrome_pool
+    with _chrome_pool_lock:
+        if _chrome_pool is None:
+            _chrome_pool = _ChromePool(_chrome_pool_size)
+            atexit.register(_chrome_pool.close)
+        return _chrome_pool
+
+
+def extract_text_from_pdf(file_path: str, workers: int = 1) -> tuple[list[str], str]:
     """Extract text content from a PDF file."""
+    contents = list(iter_pdf_paragraphs(file_path, workers))
+    return contents, detect_language(contents)
+
+
+def iter_pdf_paragraphs(file_path: str, workers: int = 1):
+    """Yield the paragraphs of a PDF file in page order, the pages are extracted by a process pool if workers > 1."""
+    import PyPDF2
+
     with open(file_path, 'rb') as f:
         pdf_reader = PyPDF2.PdfReader(f)
-        contents = []
-        for page in pdf_reader.pages:
-            page_text = page.extract_text().strip()
-            raw_text = [text.strip() for text in page_text.splitlines() if text.strip()]
-            new_text = ''
-            for text in raw_text:
-                new_text += text
-                if text[-1] in ['.', '!', '?', '。', '！', '？', '…', ';', '；', ':', '：', '”', '’', '）', '】', '》', '」',
-                                '』', '〕', '〉', '》', '〗', '〞', '〟', '»', '"', "'", ')', ']', '}']:
-                    contents.append(new_text)
-                    new_text = ''
-            if new_text:
+        num_pages = len(pdf_reader.pages)
+        ranges = [(start, min(start + _PDF_PAGES_PER_TASK, num_pages))
+                  for start in range(0, num_pages, _PDF_PAGES_PER_TASK)]
+        if workers <= 1 or num_pages < _PDF_MIN_POOL_PAGES:
+            for start, end in ranges:
+                yield from _extract_pdf_pages(pdf_reader, start, end)
+            return
+
+    # spawn, the API forks from a process with threads
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+    try:
+        futures = deque()
+        for start, end in ranges:
+            futures.append(executor.submit(_extract_pdf_file_pages, file_path, start, end))
+            # a few ranges per worker are in flight, the rest waits until the paragraphs before them are consumed
+            if len(futures) >= workers * 2:
+                yield from futures.popleft().result()
+        while futures:
+            yield from futures.popleft().result()
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+# the PDF read by a process of the pool, kept across its tasks so that the page tree is only read once
+_process_pdf = None
+
+
+def _extract_pdf_file_pages(file_path: str, start: int, end: int) -> list[str]:
+    import PyPDF2
+
+    global _process_pdf
+    if _process_pdf is None or _process_pdf[0] != file_path:
+        if _process_pdf is not None:
+            _process_pdf[1].close()
+        f = open(file_path, 'rb')
+        _process_pdf = (file_path, f, PyPDF2.PdfReader(f))
+    return _extract_pdf_pages(_process_pdf[2], start, end)
+
+
+def _extract_pdf_pages(pdf_reader: 'PyPDF2.PdfReader', start: int, end: int) -> list[str]:
+    contents = []
+    for page in pdf_reader.pages[start:end]:
+        page_text = page.extract_text().strip()
+        raw_text = [text.strip() for text in page_text.splitlines() if text.strip()]
+        new_text = ''
+        for text in raw_text:
+            new_text += text
+            if text[-1] in _SENTENCE_ENDINGS:
                 contents.append(new_text)
-        lang = detect('\n'.join(contents))
-        return contents, lang[0:2]
+                new_text = ''
+        if new_text:
+            contents.append(new_text)
+    # the objects read for these pages, such as their content streams, are dropped so the memory stays flat
+    pdf_reader.resolved_objects.clear()
+    return contents
+
+
+def detect_language(contents: list[str]) -> str:
+    """Detect the language of the text from its first paragraphs."""
+    sample = []
+    size = 0
+    for text in contents:
+        sample.append(text)
+        size += len(text)
+        if size >= _LANGUAGE_SAMPLE:
+            break
+    return detect('\n'.join(sample))[0:2]
 
 
 def extract_text_from_txt(file_path: str) -> tuple[list[str], str]:
     """Extract text content from a TXT file."""
     with open(file_path, 'r', encoding='utf-8') as f:
         contents = [text.strip() for text in f.readlines() if text.strip()]
-        lang = detect('\n'.join(contents))
-        return contents, lang[0:2]
+        return contents, detect_language(contents)
 
 
 def extract_text_from_docx(file_path: str) -> tuple[list[str], str]:
     """Extract text content from a DOCX file."""
+    import docx
+
     document = docx.Document(file_path)
     contents = [paragraph.text.strip() for paragraph in document.paragraphs if paragraph.text.strip()]
-    lang = detect('\n'.join(contents))
-    return contents, lang[0:2]
+    return contents, detect_language(contents)
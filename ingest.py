@@ -0,0 +1,424 @@
+import argparse
+import gzip
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Optional
+from xml.etree import ElementTree
+
+import numpy as np
+import requests
+import xxhash
+
+from ai import AI
+from config import Config
+from chunker import Chunker, Fragment
+from contents import web_crawler_newspaper, detect_language
+from jobs import process_alive
+from storage import Storage
+
+# the number of paragraphs a summary is generated from
+SUMMARY_CANDIDATES = 100
+# the SIF weights need words separated by spaces
+_NO_SIF_LANGUAGES = ['zh', 'ja', 'ko', 'hi', 'ar', 'fa']
+
+
+def get_hash_id(contents: list[str]) -> str:
+    """The name of the contents in the storage."""
+    return xxhash.xxh3_128_hexdigest('\n'.join(contents).encode('utf-8'))
+
+
+def use_sif(lang: str) -> bool:
+    """Whether the summary averages the embeddings with SIF weights or directly, based on the language."""
+    return lang not in _NO_SIF_LANGUAGES
+
+
+def chunk_contents(ai: AI, contents: list[str]) -> list[Fragment]:
+    """Merge and split the extracted paragraphs into the chunks that are embedded."""
+    chunks = ai.chunker.chunk(contents)
+    print(f"Chunked {len(contents)} paragraphs: {json.dumps(Chunker.stats([chunk.tokens for chunk in chunks]))}")
+    return chunks
+
+
+def save_to_storage(ai: AI, storage: Storage, contents: list[str], hash_id: str, lang: str) -> int:
+    """Embed and store the contents unless they have been indexed, returning the tokens used."""
+    if storage.been_indexed(hash_id):
+        return 0
+    embeddings, tokens = ai.create_embeddings(chunk_contents(ai, contents))
+    storage.add_all(embeddings, hash_id)
+    index_summary(ai, storage, embeddings, hash_id, lang)
+    return tokens
+
+
+def save_stream_to_storage(ai: AI, storage: Storage, paragraphs: Iterable[str], batch_size: int = 256,
+                           claim: Optional[Callable[[str], None]] = None) -> tuple[str, str, int]:
+    """Chunk and embed the paragraphs while they are still being extracted and store them unless they have been
+    indexed, returning the hash id, the language and the tokens used.
+
+    The hash id is only known once all paragraphs are read, an already indexed document is embedded again, which
+    the embedding cache answers without requests. claim is called with the hash id before it is checked, see
+    Job.claim.
+    """
+    hasher = xxhash.xxh3_128()
+    contents = []
+    embeddings = []
+    token_counts = []
+    pending = deque()
+    tokens = 0
+
+    def collect():
+        nonlocal tokens
+        created, created_tokens = pending.popleft().result()
+        # float32 arrays take a sixth of the memory of lists of floats
+        embeddings.extend(np.asarray(embedding, dtype='float32') for _, embedding in created)
+        tokens += created_tokens
+
+    def hashed(paragraphs: Iterable[str]) -> Iterable[str]:
+        first = True
+        for paragraph in paragraphs:
+            # the same digest as get_hash_id of the extracted paragraphs
+            hasher.update((paragraph if first else f'\n{paragraph}').encode('utf-8'))
+            first = False
+            yield paragraph
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        batch = []
+        for chunk in ai.chunker.iter_chunks(hashed(paragraphs)):
+            contents.append(chunk)
+            token_counts.append(chunk.tokens)
+            batch.append(chunk)
+            if len(batch) == batch_size:
+                pending.append(executor.submit(ai.create_embeddings, batch))
+                batch = []
+                # the extraction waits when the embedding falls behind
+                while len(pending) > 2:
+                    collect()
+        if batch:
+            pending.append(executor.submit(ai.create_embeddings, batch))
+        while pending:
+            collect()
+
+    if not contents:
+        raise ValueError('no text')
+    print(f"Chunked into {json.dumps(Chunker.stats(token_counts))}")
+    hash_id = hasher.hexdigest()
+    lang = detect_language(contents)
+    if claim is not None:
+        claim(hash_id)
+    if not storage.been_indexed(hash_id):
+        embeddings = list(zip(contents, embeddings))
+        storage.add_all(embeddings, hash_id)
+        index_summary(ai, storage, embeddings, hash_id, lang)
+    return hash_id, lang, tokens
+
+
+def index_summary(ai: AI, storage: Storage, embeddings, name: str, lang: str) -> dict:
+    """Rank the summary candidates of the document once and store them with its average embedding."""
+    avg_embedding, candidates = ai.summary_candidates(embeddings, SUMMARY_CANDIDATES, use_sif(lang))
+    meta = {'sif': use_sif(lang), 'avg_embedding': avg_embedding, 'candidates': candidates,
+            'candidate_tokens': [ai.fragment_tokens(candidate) for candidate in candidates], 'summaries': {}}
+    storage.set_meta(name, meta)
+    return meta
+
+
+def summary_candidates(ai: AI, storage: Storage, name: str, lang: str) -> list[str]:
+    """The stored summary candidates, ranked again if paragraphs were added since or the language changed."""
+    meta = storage.get_meta(name)
+    if 'candidates' not in meta or meta['sif'] != use_sif(lang):
+        meta = index_summary(ai, storage, storage.get_all_embeddings(name), name, lang)
+    # summaries of documents indexed by older versions count the tokens of their candidates again
+    return [Fragment(candidate, tokens) for candidate, tokens in
+            zip(meta['candidates'], meta.get('candidate_tokens', [None] * len(meta['candidates'])))]
+
+
+def _summary_key(ai: AI) -> str:
+    return f'{ai._chat_model.name}/{ai._language}'
+
+
+def get_summary(ai: AI, storage: Storage, name: str) -> str:
+    """The summary generated before for the document by the same model in the same language, or None."""
+    return storage.get_meta(name).get('summaries', {}).get(_summary_key(ai))
+
+
+def set_summary(ai: AI, storage: Storage, name: str, summary: str):
+    """Store the summary of the document, it is dropped with the candidates when paragraphs are added."""
+    meta = storage.get_meta(name)
+    if 'candidates' not in meta:
+        # the document changed while the summary was generated
+        return
+    meta['summaries'][_summary_key(ai)] = summary
+    storage.set_meta(name, meta)
+
+
+def sitemap_urls(url: str, depth: int = 3) -> list[str]:
+    """The page URLs of a sitemap, following sitemap indexes up to depth levels."""
+    response = requests.get(url, timeout=30)
+    response.raise_for_status()
+    content = response.content
+    if content[:2] == b'\x1f\x8b':
+        content = gzip.decompress(content)
+    root = ElementTree.fromstring(content)
+    locations = [element.text.strip() for element in root.iter() if element.tag.endswith('loc') and element.text]
+    if root.tag.endswith('sitemapindex'):
+        return [page for location in locations if depth > 0 for page in sitemap_urls(location, depth - 1)]
+    return locations
+
+
+class _IngestState:
+    """The status of every URL of the bulk ingestion runs, kept in sqlite so that a run can be resumed."""
+
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS item (run TEXT NOT NULL, url TEXT NOT NULL, '
+                           'status TEXT NOT NULL, uri TEXT, tokens INTEGER, error TEXT, updated REAL, '
+                           'PRIMARY KEY (run, url))')
+        # the process running each run, so that a run is not started twice by the processes of the API
+        self._conn.execute('CREATE TABLE IF NOT EXISTS run (run TEXT PRIMARY KEY, pid INTEGER, started REAL, '
+                           'finished REAL)')
+        self._conn.commit()
+
+    def claim(self, run: str) -> bool:
+        """Mark the run as running in this process, unless a process that is alive is running it."""
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._conn.execute('SELECT pid, finished FROM run WHERE run = ?', (run,)).fetchone()
+                if row is not None and row[1] is None and process_alive(row[0]):
+                    self._conn.rollback()
+                    return False
+                self._conn.execute('INSERT OR REPLACE INTO run (run, pid, started, finished) VALUES (?, ?, ?, NULL)',
+                                   (run, os.getpid(), time.time()))
+                self._conn.commit()
+            except BaseException:
+                self._conn.rollback()
+                raise
+        return True
+
+    def finish(self, run: str):
+        with self._lock:
+            self._conn.execute('UPDATE run SET finished = ? WHERE run = ? AND pid = ?', (time.time(), run, os.getpid()))
+            self._conn.commit()
+
+    def running(self, run: str) -> bool:
+        with self._lock:
+            row = self._conn.execute('SELECT pid, finished FROM run WHERE run = ?', (run,)).fetchone()
+        return row is not None and row[1] is None and process_alive(row[0])
+
+    def add(self, run: str, urls: list[str]):
+        with self._lock:
+            self._conn.executemany('INSERT OR IGNORE INTO item (run, url, status, updated) VALUES (?, ?, ?, ?)',
+                                   [(run, url, 'pending', time.time()) for url in urls])
+            self._conn.commit()
+
+    def unfinished(self, run: str) -> list[str]:
+        """The URLs of the run that are not done, the contents are not kept between stages so they start over."""
+        with self._lock:
+            rows = self._conn.execute("SELECT url FROM item WHERE run = ? AND status != 'done' ORDER BY rowid",
+                                      (run,))
+            return [url for url, in rows]
+
+    def update(self, run: str, url: str, status: str, uri: str = None, tokens: int = None, error: str = None):
+        with self._lock:
+            self._conn.execute('UPDATE item SET status = ?, uri = ?, tokens = ?, error = ?, updated = ? '
+                               'WHERE run = ? AND url = ?', (status, uri, tokens, error, time.time(), run, url))
+            self._conn.commit()
+
+    def items(self, run: str) -> list[dict]:
+        with self._lock:
+            rows = self._conn.execute('SELECT url, status, uri, tokens, error FROM item WHERE run = ? ORDER BY rowid',
+                                      (run,))
+            return [dict(zip(['url', 'status', 'uri', 'tokens', 'error'], row)) for row in rows]
+
+
+class BulkIngest:
+    """Ingest many URLs through a crawl, embed and store pipeline.
+
+    Every stage has its own threads and a bounded queue in front of it, so a slow stage holds back the ones
+    before it instead of piling up pages in memory. The status of every URL is kept in sqlite, running an
+    interrupted run again continues with the URLs that are not done.
+    """
+
+    # the status of an item once it passed the stage
+    _STAGES = {'crawl': 'crawled', 'embed': 'embedded', 'store': 'done'}
+
+    def __init__(self, cfg: Config):
+        self._cfg = cfg
+        self._ai = AI(cfg)
+        self._storage = Storage.create_storage(cfg)
+        self._state = _IngestState(cfg.ingest_state_path)
+        self._stats = {}
+        self._lock = threading.Lock()
+        # documents are stored one at a time, so the same contents from two URLs are not added twice
+        self._store_lock = threading.Lock()
+
+    def add(self, urls: list[str], run: str = None) -> str:
+        """Add the URLs to the run, a new one if it is not given, returning the run."""
+        run = run or uuid.uuid4().hex
+        self._state.add(run, list(dict.fromkeys(urls)))
+        return run
+
+    def running(self, run: str) -> bool:
+        """Whether the run is running, in this process or another one."""
+        return self._state.running(run)
+
+    def claim(self, run: str) -> bool:
+        """Claim the run for this process, False if it is running already."""
+        return self._state.claim(run)
+
+    def release(self, run: str):
+        """Release a run claimed by this process."""
+        self._state.finish(run)
+
+    def run(self, run: str, claimed: bool = False) -> dict:
+        """Ingest the URLs of the run that are not done, returning its status. The run is claimed first unless it
+        has been claimed by the caller."""
+        if not claimed and not self.claim(run):
+            raise ValueError(f'run {run} is in progress')
+        try:
+            return self._run(run)
+        finally:
+            self.release(run)
+
+    def _run(self, run: str) -> dict:
+        workers = {'crawl': self._cfg.ingest_crawl_workers, 'embed': self._cfg.ingest_embed_workers,
+                   'store': self._cfg.ingest_store_workers}
+        funcs = {'crawl': self._crawl, 'embed': self._embed, 'store': self._store}
+        inboxes = {stage: queue.Queue(maxsize=self._cfg.ingest_queue_size) for stage in self._STAGES}
+        with self._lock:
+            urls = self._state.unfinished(run)
+            self._stats[run] = {'started': time.time(), 'items': len(urls), 'queues': inboxes,
+                                'stages': {stage: {'items': 0, 'failed': 0, 'seconds': 0.0} for stage in self._STAGES}}
+
+        stages = list(self._STAGES)
+        threads = {}
+        for i, stage in enumerate(stages):
+            outbox = inboxes[stages[i + 1]] if i + 1 < len(stages) else None
+            threads[stage] = [threading.Thread(target=self._worker, args=(run, stage, funcs[stage], inboxes[stage],
+                                                                           outbox), daemon=True)
+                              for _ in range(workers[stage])]
+            for thread in threads[stage]:
+                thread.start()
+
+        # put blocks while the crawl queue is full, this is where the backpressure ends
+        for url in urls:
+            inboxes['crawl'].put(url)
+        # a stage is finished once its workers took one end marker each and everything before it is finished
+        for stage in stages:
+            for _ in threads[stage]:
+                inboxes[stage].put(None)
+            for thread in threads[stage]:
+                thread.join()
+
+        with self._lock:
+            self._stats[run]['finished'] = time.time()
+        status = self.status(run)
+        print(f"Ingestion {run} finished: {json.dumps(status['counts'])}, {status['items_per_second']:.2f} items/s")
+        return status
+
+    def status(self, run: str, items: bool = False) -> dict:
+        """The number of URLs per status, whether the run is running in any process, the throughput of the last run
+        in this process and, if asked, the status of every URL."""
+        all_items = self._state.items(run)
+        counts = {}
+        for item in all_items:
+            counts[item['status']] = counts.get(item['status'], 0) + 1
+        result = {'run': run, 'counts': counts, 'tokens': sum(item['tokens'] or 0 for item in all_items),
+                  'running': self.running(run)}
+        with self._lock:
+            stats = self._stats.get(run)
+            if stats is not None:
+                elapsed = stats.get('finished', time.time()) - stats['started']
+                done = stats['stages']['store']['items']
+                result.update(running='finished' not in stats, elapsed=elapsed,
+                              items_per_second=done / elapsed if elapsed > 0 else 0,
+                              stages={stage: dict(stage_stats, queued=stats['queues'][stage].qsize())
+                                      for stage, stage_stats in stats['stages'].items()})
+        if items:
+            result['items'] = all_items
+        return result
+
+    def _worker(self, run: str, stage: str, func, inbox: queue.Queue, outbox: Optional[queue.Queue]):
+        while True:
+            item = inbox.get()
+            if item is None:
+                return
+            url = item if isinstance(item, str) else item['url']
+            start = time.perf_counter()
+            try:
+                item = func(item)
+            except Exception as e:
+                print(f"Ingesting {url} failed at {stage}: {e}")
+                self._state.update(run, url, 'failed', error=f'{stage}: {e}')
+                self._record(run, stage, start, failed=True)
+                continue
+            self._record(run, stage, start)
+            if outbox is not None:
+                self._state.update(run, url, self._STAGES[stage])
+                outbox.put(item)
+            else:
+                self._state.update(run, url, 'done', uri=f"{item['hash_id']}/{item['lang']}", tokens=item['tokens'])
+
+    def _record(self, run: str, stage: str, start: float, failed: bool = False):
+        with self._lock:
+            stage_stats = self._stats[run]['stages'][stage]
+            stage_stats['failed' if failed else 'items'] += 1
+            stage_stats['seconds'] += time.perf_counter() - start
+
+    def _crawl(self, url: str) -> dict:
+        # web_crawler_newspaper also extracts the article and detects its language
+        contents, lang = web_crawler_newspaper(url)
+        if not contents:
+            raise ValueError('no content')
+        return {'url': url, 'contents': contents, 'lang': lang, 'hash_id': get_hash_id(contents),
+                'embeddings': None, 'tokens': 0}
+
+    def _embed(self, item: dict) -> dict:
+        if not self._storage.been_indexed(item['hash_id']):
+            item['embeddings'], item['tokens'] = self._ai.create_embeddings(chunk_contents(self._ai, item['contents']))
+        return item
+
+    def _store(self, item: dict) -> dict:
+        with self._store_lock:
+            if item['embeddings'] is not None and not self._storage.been_indexed(item['hash_id']):
+                self._storage.add_all(item['embeddings'], item['hash_id'])
+                index_summary(self._ai, self._storage, item['embeddings'], item['hash_id'], item['lang'])
+        return item
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Ingest many URLs into the storage.')
+    parser.add_argument('urls', nargs='*', help='the URLs to ingest')
+    parser.add_argument('--file', help='a file with one URL per line')
+    parser.add_argument('--sitemap', help='ingest the pages of a sitemap')
+    parser.add_argument('--run', help='resume this run, adding the given URLs to it')
+    args = parser.parse_args()
+
+    urls = list(args.urls)
+    if args.file:
+        with open(args.file, 'r', encoding='utf-8') as f:
+            urls += [line.strip() for line in f if line.strip()]
+    if args.sitemap:
+        urls += sitemap_urls(args.sitemap)
+    if not urls and not args.run:
+        parser.error('no URLs to ingest')
+
+    bulk = BulkIngest(Config())
+    run = bulk.add(urls, args.run)
+    print(f"Ingestion run {run}, run again with --run {run} to resume it")
+    status = bulk.run(run)
+    print(json.dumps(status, indent=2))
+
+
+if __name__ == '__main__':
+    main()
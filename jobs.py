@@ -0,0 +1,212 @@
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Callable, Optional
+
+# finished jobs are deleted after a week, when a job queue starts
+_RETENTION_SECONDS = 7 * 24 * 3600
+# how often a job waiting for another one checks whether it finished
+_POLL_SECONDS = 0.5
+# the Windows API constants process_alive uses
+_PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+_ERROR_ACCESS_DENIED = 5
+_STILL_ACTIVE = 259
+_COLUMNS = ['id', 'kind', 'source', 'status', 'progress', 'hash_id', 'result', 'error', 'created', 'started',
+            'updated']
+
+
+class Job:
+    """The handle a job function reports its progress with and claims its document."""
+
+    def __init__(self, jobs: 'JobQueue', job_id: str):
+        self._jobs = jobs
+        self.id = job_id
+
+    def progress(self, stage: str, **details):
+        """Record the stage the job is in, with details such as the number of chunks."""
+        self._jobs._update(self.id, progress=json.dumps(dict(details, stage=stage)))
+
+    def claim(self, hash_id: str):
+        """Claim the document with the content hash, waiting while another job is storing it.
+
+        The caller then checks whether the document has been indexed, so the same contents submitted twice, e.g.
+        from two URLs, are embedded once.
+        """
+        while True:
+            owner = self._jobs._claim(self.id, hash_id)
+            if owner is None:
+                return
+            self.progress('waiting', job=owner)
+            while self._jobs._running(owner):
+                time.sleep(_POLL_SECONDS)
+
+
+class JobQueue:
+    """Run ingestion jobs on a pool of threads, keeping their state in sqlite.
+
+    Submitting a job with the key of a job that is queued or running, e.g. the same URL, returns that job, and at
+    most queue_size jobs wait for a thread, submitting more fails. The state is shared by the processes of the API
+    through the sqlite file, so the status of a job can be asked from any of them, while the job runs in the
+    process it was submitted to. Jobs left unfinished by a process that is gone are marked as failed.
+    """
+
+    def __init__(self, path: str, workers: int = 2, queue_size: int = 64):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        # transactions are begun explicitly, so that a check and the write after it are atomic across processes
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS job (id TEXT PRIMARY KEY, kind TEXT NOT NULL, '
+                           'source TEXT NOT NULL, key TEXT NOT NULL, status TEXT NOT NULL, progress TEXT, '
+                           'hash_id TEXT, result TEXT, error TEXT, pid INTEGER, created REAL, started REAL, '
+                           'updated REAL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS job_key ON job (key, status)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS job_hash_id ON job (hash_id, status)')
+        self._recover()
+        self._inbox = queue.Queue(maxsize=queue_size)
+        for _ in range(workers):
+            threading.Thread(target=self._worker, daemon=True).start()
+
+    def submit(self, kind: str, source: str, key: str, func: Callable[[Job], dict]) -> tuple[str, bool]:
+        """Queue func to run with the job, returning the job id and whether it is a job already in flight."""
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                rows = self._conn.execute("SELECT id, pid FROM job WHERE key = ? AND status IN ('queued', 'running')",
+                                          (key,)).fetchall()
+                in_flight = [job_id for job_id, pid in rows if process_alive(pid)]
+                if in_flight:
+                    self._conn.execute('COMMIT')
+                    return in_flight[0], True
+                job_id = uuid.uuid4().hex
+                now = time.time()
+                self._conn.execute('INSERT INTO job (id, kind, source, key, status, pid, created, updated) '
+                                   "VALUES (?, ?, ?, ?, 'queued', ?, ?, ?)",
+                                   (job_id, kind, source, key, os.getpid(), now, now))
+                self._inbox.put_nowait((job_id, func))
+                self._conn.execute('COMMIT')
+            except queue.Full:
+                self._conn.execute('ROLLBACK')
+                raise ValueError('too many jobs are queued, try again later') from None
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+        return job_id, False
+
+    def status(self, job_id: str) -> Optional[dict]:
+        """The status of the job, its stage while it runs and its result once it is done, None if it is unknown."""
+        with self._lock:
+            row = self._conn.execute(f'SELECT {", ".join(_COLUMNS)} FROM job WHERE id = ?', (job_id,)).fetchone()
+        return self._job(row) if row is not None else None
+
+    def jobs(self, status: str = None, limit: int = 50) -> list[dict]:
+        """The most recent jobs, of any status or of the given one."""
+        query = f'SELECT {", ".join(_COLUMNS)} FROM job'
+        params = []
+        if status:
+            query += ' WHERE status = ?'
+            params.append(status)
+        with self._lock:
+            rows = self._conn.execute(query + ' ORDER BY created DESC LIMIT ?', params + [limit]).fetchall()
+        return [self._job(row) for row in rows]
+
+    def counts(self) -> dict:
+        """The number of jobs per status, and the jobs of this process waiting for a thread."""
+        with self._lock:
+            counts = dict(self._conn.execute('SELECT status, COUNT(*) FROM job GROUP BY status'))
+        return {'jobs': counts, 'waiting': self._inbox.qsize()}
+
+    def _worker(self):
+        while True:
+            job_id, func = self._inbox.get()
+            self._update(job_id, status='running', started=time.time())
+            try:
+                result = func(Job(self, job_id))
+            except Exception as e:
+                print(f"Job {job_id} failed: {e}")
+                self._update(job_id, status='failed', error=str(e))
+                continue
+            self._update(job_id, status='done', result=json.dumps(result))
+
+    def _update(self, job_id: str, **values):
+        values['updated'] = time.time()
+        with self._lock:
+            self._conn.execute(f'UPDATE job SET {", ".join(f"{name} = ?" for name in values)} WHERE id = ?',
+                               list(values.values()) + [job_id])
+
+    def _claim(self, job_id: str, hash_id: str) -> Optional[str]:
+        """Set the content hash of the job, unless another running job has it, whose id is returned."""
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                rows = self._conn.execute("SELECT id, pid FROM job WHERE hash_id = ? AND status = 'running' "
+                                          'AND id != ?', (hash_id, job_id)).fetchall()
+                # a job of a process that is gone does not hold its document
+                owners = [owner for owner, pid in rows if process_alive(pid)]
+                if not owners:
+                    self._conn.execute('UPDATE job SET hash_id = ?, updated = ? WHERE id = ?',
+                                       (hash_id, time.time(), job_id))
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+        return owners[0] if owners else None
+
+    def _running(self, job_id: str) -> bool:
+        with self._lock:
+            row = self._conn.execute('SELECT status, pid FROM job WHERE id = ?', (job_id,)).fetchone()
+        return row is not None and row[0] == 'running' and process_alive(row[1])
+
+    def _recover(self):
+        """Fail the unfinished jobs of processes that are gone and delete old finished jobs."""
+        with self._lock:
+            rows = self._conn.execute("SELECT id, pid FROM job WHERE status IN ('queued', 'running')").fetchall()
+            # the queue of this process has just started, its jobs are from an earlier process with the same pid
+            lost = [job_id for job_id, pid in rows if pid == os.getpid() or not process_alive(pid)]
+            now = time.time()
+            self._conn.executemany("UPDATE job SET status = 'failed', error = 'interrupted, submit it again', "
+                                   'updated = ? WHERE id = ?', [(now, job_id) for job_id in lost])
+            self._conn.execute("DELETE FROM job WHERE status IN ('done', 'failed') AND updated < ?",
+                               (now - _RETENTION_SECONDS,))
+        if lost:
+            print(f"Marked {len(lost)} interrupted jobs as failed")
+
+    @staticmethod
+    def _job(row) -> dict:
+        job = dict(zip(_COLUMNS, row))
+        for name in ['progress', 'result']:
+            job[name] = json.loads(job[name]) if job[name] else None
+        return job
+
+
+def process_alive(pid: int) -> bool:
+    """Whether a process with the pid is running, without signalling it."""
+    if os.name == 'nt':
+        # os.kill terminates the process on Windows, whatever the signal, so its exit code is asked for instead
+        import ctypes
+
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(_PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+        if not handle:
+            # a process of another user can not be opened but exists
+            return kernel32.GetLastError() == _ERROR_ACCESS_DENIED
+        try:
+            exit_code = ctypes.c_ulong()
+            if not kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code)):
+                return True
+            return exit_code.value == _STILL_ACTIVE
+        finally:
+            kernel32.CloseHandle(handle)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
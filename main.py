@@ -1,22 +1,26 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from api import api
 from config import Config
-from console import console
-from webui import webui
 
 
 def run():
     """Run the program."""
     cfg = Config()
 
+    # each mode imports only its own dependencies, the API and the console do not load gradio
     mode = cfg.mode
     if mode == 'console':
+        from console import console
+
         console(cfg)
     elif mode == 'api':
+        from api import api
+
         api(cfg)
     elif mode == 'webui':
+        from webui import webui
+
         webui(cfg)
     else:
         raise ValueError('mode must be console or api')
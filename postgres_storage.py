@@ -0,0 +1,304 @@
+import csv
+import io
+import json
+import threading
+from typing import Optional
+
+import numpy as np
+from pgvector.sqlalchemy import Vector
+from sqlalchemy import create_engine, func, insert, literal_column, select, text, Column, Integer, String
+from sqlalchemy.orm import sessionmaker, declarative_base
+
+from bm25 import reciprocal_rank_fusion, tokenize
+from chunker import Fragment, num_tokens
+from config import Config
+from storage import Storage
+
+Base = declarative_base()
+
+
+def singleton(cls):
+    instances = {}
+
+    def get_instance(cfg):
+        if cls not in instances:
+            instances[cls] = cls(cfg)
+        return instances[cls]
+
+    return get_instance
+
+
+@singleton
+class PostgresStorage(Storage):
+    """PostgresStorage class.
+
+    The engine and its connection pool are shared, every call runs in its own session, so the storage can be
+    used from concurrent requests.
+    """
+
+    def __init__(self, cfg: Config):
+        """Initialize the storage."""
+        self._postgresql = cfg.postgres_url
+        self._engine = create_engine(self._postgresql, pool_size=cfg.postgres_pool_size,
+                                     max_overflow=cfg.postgres_max_overflow, pool_pre_ping=True)
+        with self._engine.begin() as connection:
+            connection.execute(text('CREATE EXTENSION IF NOT EXISTS vector'))
+        Base.metadata.create_all(self._engine)
+        self._session = sessionmaker(bind=self._engine)
+        self._index_type = cfg.postgres_index_type
+        self._hnsw_m = cfg.postgres_hnsw_m
+        self._hnsw_ef_construction = cfg.postgres_hnsw_ef_construction
+        self._ef_search = cfg.postgres_ef_search
+        self._probes = cfg.postgres_probes
+        self._hybrid_search = cfg.hybrid_search
+        self._rrf_k = cfg.hybrid_rrf_k
+        self._ivfflat_building = threading.Lock()
+        with self._engine.connect() as connection:
+            version = connection.execute(
+                text("SELECT extversion FROM pg_extension WHERE extname = 'vector'")).scalar() or '0'
+        # before 0.8 the vector index is scanned once, so filtering by name can return less than the limit
+        self._iterative_scan = tuple(int(v) for v in version.split('.')[:2]) >= (0, 8)
+        self._create_indexes()
+
+    _HNSW_INDEX = 'embedding_embedding_hnsw_idx'
+    _IVFFLAT_INDEX = 'embedding_embedding_ivfflat_idx'
+    # IVFFlat lists are trained on the rows present when the index is built, so it waits for enough rows
+    _IVFFLAT_MIN_ROWS = 10000
+    # the ranges of CJK characters of bm25.tokenize, as escapes of the regular expressions of Postgres
+    _CJK = '\\u3040-\\u30ff\\u3400-\\u4dbf\\u4e00-\\u9fff\\uac00-\\ud7af'
+
+    def _create_indexes(self):
+        """Create the token counts and full-text columns and their indexes for tables created by older versions,
+        and the vector index."""
+        with self._engine.begin() as connection:
+            connection.execute(text('ALTER TABLE embedding ADD COLUMN IF NOT EXISTS tokens integer'))
+            expression = connection.execute(text(
+                "SELECT generation_expression FROM information_schema.columns "
+                "WHERE table_name = 'embedding' AND column_name = 'tsv'")).scalar()
+            # older versions indexed a run of CJK characters as one word, which the terms of a query never match
+            if expression is not None and 'regexp_replace' not in expression:
+                connection.execute(text('ALTER TABLE embedding DROP COLUMN tsv'))
+            # the simple configuration lowercases words without stemming or stop words, for every language, and
+            # CJK characters are spaced out so that each one is a word, as bm25.tokenize splits them
+            connection.execute(text(
+                "ALTER TABLE embedding ADD COLUMN IF NOT EXISTS tsv tsvector GENERATED ALWAYS AS "
+                f"(to_tsvector('simple', regexp_replace(coalesce(text, ''), '([{self._CJK}])', ' \\1 ', 'g'))) STORED"))
+            connection.execute(text('CREATE INDEX IF NOT EXISTS ix_embedding_name ON embedding (name)'))
+            connection.execute(text('CREATE INDEX IF NOT EXISTS ix_embedding_tsv ON embedding USING gin (tsv)'))
+            if self._index_type == 'hnsw':
+                connection.execute(text(
+                    f'CREATE INDEX IF NOT EXISTS {self._HNSW_INDEX} ON embedding '
+                    f'USING hnsw (embedding vector_cosine_ops) '
+                    f'WITH (m = {int(self._hnsw_m)}, ef_construction = {int(self._hnsw_ef_construction)})'))
+        if self._index_type == 'ivfflat':
+            self._maintain_ivfflat_index()
+
+    def _maintain_ivfflat_index(self):
+        """Build the IVFFlat index in the background when the table has outgrown its number of lists."""
+        with self._engine.connect() as connection:
+            lists = self._ivfflat_lists(connection)
+        # one build at a time in this process, the advisory lock of the build covers the other processes
+        if lists is not None and self._ivfflat_building.acquire(blocking=False):
+            threading.Thread(target=self._build_ivfflat_index, daemon=True).start()
+
+    def _ivfflat_lists(self, connection) -> Optional[int]:
+        """The number of lists to build the IVFFlat index with, None when it does not need to be built.
+
+        The rows are estimated from the planner statistics, counting them would scan the whole table.
+        """
+        rows = connection.execute(text("SELECT reltuples FROM pg_class WHERE relname = 'embedding'")).scalar() or 0
+        options = connection.execute(text(
+            f"SELECT reloptions FROM pg_class WHERE relname = '{self._IVFFLAT_INDEX}'")).scalar()
+        if rows < self._IVFFLAT_MIN_ROWS:
+            return None
+        # pgvector recommends rows / 1000 lists up to a million rows
+        lists = max(1, int(rows) // 1000)
+        current = int(options[0].split('=')[1]) if options else None
+        if current is not None and current * 2 > lists:
+            return None
+        return lists
+
+    def _build_ivfflat_index(self):
+        """Build the IVFFlat index under a temporary name and swap it in.
+
+        The index is built concurrently, so writes and searches go on during the build and searches use the old
+        index until the new one replaces it.
+        """
+        try:
+            with self._engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+                locked = connection.execute(text('SELECT pg_try_advisory_lock(hashtext(:name))'),
+                                            {'name': self._IVFFLAT_INDEX}).scalar()
+                if not locked:
+                    return
+                try:
+                    # another process may have built it while this one was waiting
+                    lists = self._ivfflat_lists(connection)
+                    if lists is None:
+                        return
+                    print(f"Building the IVFFlat index with {lists} lists")
+                    building = f'{self._IVFFLAT_INDEX}_new'
+                    # an interrupted build leaves an invalid index behind
+                    connection.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS {building}'))
+                    connection.execute(text(
+                        f'CREATE INDEX CONCURRENTLY {building} ON embedding '
+                        f'USING ivfflat (embedding vector_cosine_ops) WITH (lists = {lists})'))
+                    connection.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS {self._IVFFLAT_INDEX}'))
+                    connection.execute(text(f'ALTER INDEX {building} RENAME TO {self._IVFFLAT_INDEX}'))
+                    print(f"Built the IVFFlat index with {lists} lists")
+                finally:
+                    connection.execute(text('SELECT pg_advisory_unlock(hashtext(:name))'),
+                                       {'name': self._IVFFLAT_INDEX})
+        except Exception as e:
+            print(f"Building the IVFFlat index failed: {e}")
+        finally:
+            self._ivfflat_building.release()
+
+    def _search_session(self):
+        """A session with the search parameters of the vector index set for its transaction."""
+        session = self._session()
+        session.begin()
+        if self._index_type == 'hnsw':
+            session.execute(text(f'SET LOCAL hnsw.ef_search = {int(self._ef_search)}'))
+            if self._iterative_scan:
+                session.execute(text('SET LOCAL hnsw.iterative_scan = strict_order'))
+        elif self._index_type == 'ivfflat':
+            session.execute(text(f'SET LOCAL ivfflat.probes = {int(self._probes)}'))
+            if self._iterative_scan:
+                session.execute(text('SET LOCAL ivfflat.iterative_scan = relaxed_order'))
+        return session
+
+    def add_all(self, embeddings: list[tuple[str, list[float]]], name: str):
+        """Add multiple embeddings."""
+        with self._session.begin() as session:
+            session.query(self.MetaEntity).where(self.MetaEntity.name == name).delete()
+        self._insert(embeddings, name)
+        if self._index_type == 'ivfflat':
+            self._maintain_ivfflat_index()
+
+    def _insert(self, embeddings: list[tuple[str, list[float]]], name: str):
+        connection = self._engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            if hasattr(cursor, 'copy_expert'):
+                # psycopg2 streams the whole document to the server in one COPY
+                cursor.copy_expert('COPY embedding (name, text, tokens, embedding) FROM STDIN '
+                                   'WITH (FORMAT csv, FORCE_NULL (tokens))', self._to_csv(embeddings, name))
+                connection.commit()
+                return
+        finally:
+            connection.close()
+        with self._session.begin() as session:
+            session.execute(insert(self.EmbeddingEntity), [
+                {'name': name, 'text': text, 'tokens': num_tokens(text), 'embedding': embedding}
+                for text, embedding in embeddings])
+
+    @staticmethod
+    def _to_csv(embeddings: list[tuple[str, list[float]]], name: str) -> io.StringIO:
+        buffer = io.StringIO()
+        # every field is quoted, so that an empty text is not read as NULL, unknown token counts are NULL
+        writer = csv.writer(buffer, quoting=csv.QUOTE_ALL)
+        for text, embedding in embeddings:
+            vector = ','.join(map(str, np.asarray(embedding, dtype='float32').tolist()))
+            writer.writerow([name, text, num_tokens(text), f'[{vector}]'])
+        buffer.seek(0)
+        return buffer
+
+    def get_texts(self, embedding: list[float], name: str, limit=100, query: str = None) -> list[str]:
+        """Get the text for the provided embedding, fused with a full-text search of the query if it is given."""
+        with self._search_session() as session:
+            result = self._search(session, self.EmbeddingEntity.name == name, embedding, limit, query)
+            return [Fragment(s.text, s.tokens, f'paragraph {s.id}: ', score) for s, score in result]
+
+    def _search(self, session, where, embedding: list[float], limit: int, query: Optional[str]):
+        """The rows closest to the embedding with their cosine similarities, fused by rank with the rows that best
+        match the terms of the query, which have no similarity like in the FAISS storage."""
+        distance = self.EmbeddingEntity.embedding.cosine_distance(embedding)
+        result = [(s, 1 - d) for s, d in
+                  session.query(self.EmbeddingEntity, distance).where(where).order_by(distance).limit(limit)]
+        # any of the terms matches, the terms are runs of word characters which tsquery takes literally
+        terms = ' | '.join(dict.fromkeys(tokenize(query))) if self._hybrid_search and query else ''
+        if not terms:
+            return result
+        tsv = literal_column('tsv')
+        tsquery = func.to_tsquery('simple', terms)
+        lexical = session.query(self.EmbeddingEntity.id).where(where, tsv.op('@@')(tsquery)).order_by(
+            func.ts_rank_cd(tsv, tsquery).desc()).limit(limit).all()
+        rows = {s.id: (s, d) for s, d in result}
+        ids = reciprocal_rank_fusion([list(rows), [i for i, in lexical]], limit, self._rrf_k)
+        missing = [i for i in ids if i not in rows]
+        if missing:
+            rows.update((s.id, (s, None)) for s in session.query(self.EmbeddingEntity).where(
+                self.EmbeddingEntity.id.in_(missing)))
+        return [rows[i] for i in ids]
+
+    def get_all_embeddings(self, name: str):
+        """Get all embeddings."""
+        with self._session() as session:
+            result = session.query(self.EmbeddingEntity).where(self.EmbeddingEntity.name == name).order_by(
+                self.EmbeddingEntity.id).all()
+            return [(Fragment(s.text, s.tokens), s.embedding) for s in result]
+
+    def create_collection(self, collection: str, names: list[str]):
+        """Create or replace a collection of documents that are searched together."""
+        with self._session.begin() as session:
+            indexed = {name for name, in session.query(self.EmbeddingEntity.name)
+                       .filter(self.EmbeddingEntity.name.in_(names)).distinct()}
+            names = [name for name in dict.fromkeys(names) if name in indexed]
+            if not names:
+                raise ValueError(f'no indexed document in collection {collection}')
+            session.query(self.CollectionEntity).where(self.CollectionEntity.collection == collection).delete()
+            session.add_all([self.CollectionEntity(collection=collection, name=name) for name in names])
+
+    def get_collection_texts(self, embedding: list[float], collection: str, limit=100, query: str = None) \
+            -> list[str]:
+        """Get the text for the provided embedding from all documents of the collection, merged by score, and
+        fused with a full-text search of the query over its documents if it is given."""
+        names = select(self.CollectionEntity.name).where(self.CollectionEntity.collection == collection)
+        with self._search_session() as session:
+            result = self._search(session, self.EmbeddingEntity.name.in_(names), embedding, limit, query)
+            return [Fragment(s.text, s.tokens, f'document {s.name} paragraph {s.id}: ', score)
+                    for s, score in result]
+
+    def get_meta(self, name: str) -> dict:
+        """Get the metadata of the document."""
+        with self._session() as session:
+            meta = session.get(self.MetaEntity, name)
+            return json.loads(meta.meta) if meta else {}
+
+    def set_meta(self, name: str, meta: dict):
+        """Set the metadata of the document, it is dropped when paragraphs are added or the document is cleared."""
+        with self._session.begin() as session:
+            session.merge(self.MetaEntity(name=name, meta=json.dumps(meta, ensure_ascii=False)))
+
+    def clear(self, name: str):
+        """Clear the database."""
+        with self._session.begin() as session:
+            session.query(self.EmbeddingEntity).where(self.EmbeddingEntity.name == name).delete()
+            session.query(self.MetaEntity).where(self.MetaEntity.name == name).delete()
+
+    def been_indexed(self, name: str) -> bool:
+        with self._session() as session:
+            return session.query(self.EmbeddingEntity.id).filter_by(name=name).first() is not None
+
+    def stats(self) -> dict:
+        """Get the connection pool statistics."""
+        return {'pool': self._engine.pool.status()}
+
+    class EmbeddingEntity(Base):
+        __tablename__ = 'embedding'
+        id = Column(Integer, primary_key=True)
+        name = Column(String, index=True)
+        text = Column(String)
+        tokens = Column(Integer)
+        embedding = Column(Vector(1536))
+
+    class CollectionEntity(Base):
+        __tablename__ = 'collection'
+        id = Column(Integer, primary_key=True)
+        collection = Column(String, index=True)
+        name = Column(String)
+
+    class MetaEntity(Base):
+        __tablename__ = 'meta'
+        name = Column(String, primary_key=True)
+        meta = Column(String)
@@ -1,16 +1,29 @@
+import json
+import math
+import mmap
 import os.path
+import struct
+import threading
+import zlib
 from abc import ABC, abstractmethod
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Optional
 
-import faiss
 import numpy as np
-import pandas as pd
-from pgvector.sqlalchemy import Vector
-from sqlalchemy import create_engine, Column, Integer, String
-from sqlalchemy.orm import sessionmaker, declarative_base
 
+from bm25 import BM25Index, reciprocal_rank_fusion
+from chunker import Fragment, num_tokens
 from config import Config
 
-Base = declarative_base()
+try:
+    import fcntl
+except ImportError:
+    # no file locks on Windows, there the API runs in one process
+    fcntl = None
+
+# faiss is imported by the functions that use it, and the PostgreSQL storage by create_storage, so that each
+# backend only loads its own dependencies
 
 
 class Storage(ABC):
@@ -21,7 +34,10 @@ class Storage(ABC):
     def create_storage(cfg: Config) -> 'Storage':
         """Create a storage object."""
         if cfg.use_postgres:
-            return _PostgresStorage(cfg)
+            # SQLAlchemy and pgvector are only loaded with PostgreSQL
+            from postgres_storage import PostgresStorage
+
+            return PostgresStorage(cfg)
         else:
             return _IndexStorage(cfg)
 
@@ -31,15 +47,46 @@ class Storage(ABC):
         pass
 
     @abstractmethod
-    def get_texts(self, embedding: list[float], name: str, limit=100) -> list[str]:
-        """Get the text for the provided embedding."""
+    def get_texts(self, embedding: list[float], name: str, limit=100, query: str = None) -> list[str]:
+        """Get the text for the provided embedding, fused with a full-text search of the query if it is given.
+
+        The texts are fragments with their token counts and their cosine similarity to the embedding as score,
+        None for texts found by the full-text search only.
+        """
         pass
 
+    def get_texts_batch(self, embeddings: list[list[float]], name: str, limit=100,
+                        queries: list[str] = None) -> list[list[str]]:
+        """Get the texts for each of the provided embeddings and queries."""
+        queries = queries or [None] * len(embeddings)
+        return [self.get_texts(embedding, name, limit, query) for embedding, query in zip(embeddings, queries)]
+
     @abstractmethod
     def get_all_embeddings(self, name: str):
         """Get all embeddings."""
         pass
 
+    @abstractmethod
+    def create_collection(self, collection: str, names: list[str]):
+        """Create or replace a collection of documents that are searched together."""
+        pass
+
+    @abstractmethod
+    def get_collection_texts(self, embedding: list[float], collection: str, limit=100, query: str = None) \
+            -> list[str]:
+        """Get the text for the provided embedding from all documents of the collection, merged by score."""
+        pass
+
+    @abstractmethod
+    def get_meta(self, name: str) -> dict:
+        """Get the metadata of the document, empty if it has none or it changed since it was set."""
+        pass
+
+    @abstractmethod
+    def set_meta(self, name: str, meta: dict):
+        """Set the metadata of the document, it is dropped when paragraphs are added or the document is cleared."""
+        pass
+
     @abstractmethod
     def clear(self, name: str):
         """Clear the database."""
@@ -50,122 +97,795 @@ class Storage(ABC):
         """Check if the database has been indexed."""
         pass
 
+    def compact(self, name: str):
+        """Compact the storage of the name, if the storage supports it."""
+        pass
+
+    def stats(self) -> dict:
+        """Get the storage statistics."""
+        return {}
+
+
+class _IndexCache:
+    """A process-wide LRU cache of loaded indexes, bounded by memory size.
+
+    A value can be cached with the version of the files it was loaded from, it is loaded again when they
+    changed, e.g. because another process of the API wrote them, and with a function that closes it once it is
+    dropped.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        # the keys being loaded: their lock, the number of threads using it and the times they were invalidated
+        self._loading = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(self, key, loader, version=None, close=None):
+        """Get the cached value for the key, loading it with the loader on a miss or when it was cached with
+        another version."""
+        with self._lock:
+            value = self._lookup(key, version)
+            if value is not None:
+                return value
+            loading = self._loading.setdefault(key, [threading.Lock(), 0, 0])
+            loading[1] += 1
+        try:
+            # only one thread loads a given key, the others wait for it and then hit the cache
+            with loading[0]:
+                with self._lock:
+                    value = self._lookup(key, version)
+                    if value is not None:
+                        return value
+                    self._misses += 1
+                    generation = loading[2]
+                value, size = loader()
+                with self._lock:
+                    # the key was invalidated while loading, so the value may be stale
+                    if loading[2] == generation:
+                        self._put(key, value, size, version, close)
+                return value
+        finally:
+            with self._lock:
+                loading[1] -= 1
+                if not loading[1]:
+                    del self._loading[key]
+
+    def invalidate(self, key):
+        """Drop the key from the cache."""
+        with self._lock:
+            if key in self._loading:
+                self._loading[key][2] += 1
+            self._drop(key)
+
+    def stats(self) -> dict:
+        """Get the cache statistics."""
+        with self._lock:
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+            }
+
+    def _lookup(self, key, version):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[2] != version:
+            self._drop(key)
+            return None
+        self._entries.move_to_end(key)
+        self._hits += 1
+        return entry[0]
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[1]
+            self._close(entry)
+
+    def _put(self, key, value, size, version, close):
+        if size > self.max_bytes:
+            return
+        self._drop(key)
+        self._entries[key] = (value, size, version, close)
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            _, entry = self._entries.popitem(last=False)
+            self._bytes -= entry[1]
+            self._evictions += 1
+            self._close(entry)
+
+    @staticmethod
+    def _close(entry):
+        value, _, _, close = entry
+        if close is not None:
+            close(value)
+
+
+_index_cache = None
+_index_cache_lock = threading.Lock()
+
+
+def _get_index_cache(cfg: Config) -> _IndexCache:
+    global _index_cache
+    with _index_cache_lock:
+        if _index_cache is None:
+            _index_cache = _IndexCache(cfg.index_cache_mb * 1024 * 1024)
+        return _index_cache
+
+
+# faiss warns below 39 training points per IVF list, smaller documents are searched exactly instead
+_MIN_TRAINING_POINTS_PER_LIST = 39
+_MIN_IVF_TRAINING_POINTS = 1024
+
+
+def _create_index(vectors: np.ndarray, cfg: Config):
+    """Create the FAISS index configured by cfg.index_type, trained on the vectors if it needs training."""
+    import faiss
+
+    index_type = cfg.index_type
+    n, dims = vectors.shape
+    if index_type.startswith('IVF') and n < _MIN_IVF_TRAINING_POINTS:
+        print(f"Only {n} vectors to train {index_type}, use Flat instead")
+        index_type = 'Flat'
+    nlist = cfg.index_nlist or int(4 * math.sqrt(n))
+    nlist = max(1, min(nlist, n // _MIN_TRAINING_POINTS_PER_LIST))
+    # each PQ sub-quantizer has 2 ** nbits centroids, trained on the same vectors
+    pq_nbits = max(1, min(8, int(math.log2(max(2, n // _MIN_TRAINING_POINTS_PER_LIST)))))
+    description = {
+        'Flat': 'IDMap2,Flat',
+        'HNSW': f'IDMap2,HNSW{cfg.index_hnsw_m}',
+        'IVF': f'IDMap2,IVF{nlist},Flat',
+        'IVFPQ': f'IDMap2,IVF{nlist},PQ{cfg.index_pq_m}x{pq_nbits}',
+        'IVFSQ8': f'IDMap2,IVF{nlist},SQ8',
+    }[index_type]
+    index = faiss.index_factory(dims, description, faiss.METRIC_INNER_PRODUCT)
+    if not index.is_trained:
+        index.train(vectors)
+    if index_type.startswith('IVF'):
+        # get_all_embeddings reconstructs vectors by id, which IVF only supports with a direct map
+        faiss.extract_index_ivf(index).make_direct_map()
+    _tune_index(index, cfg)
+    return index
+
+
+def _tune_index(index, cfg: Config):
+    """Apply the search time parameters, they are not saved with the index."""
+    import faiss
+
+    inner = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap2) else index
+    if isinstance(inner, faiss.IndexHNSW):
+        inner.hnsw.efSearch = cfg.index_ef_search
+    elif isinstance(inner, faiss.IndexIVF):
+        inner.nprobe = cfg.index_nprobe
+
+
+@contextmanager
+def _file_lock(path: str, exclusive: bool):
+    """Hold an advisory lock on the file across the processes of the API, shared by readers and exclusive for
+    writers. The lock file is created on first use and never deleted, so that all processes lock the same file."""
+    if fcntl is None:
+        yield
+        return
+    with open(path, 'a') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def _read_index(path: str, mapped: bool):
+    """Read a FAISS index, through mmap if mapped, so that the processes of the API share the pages of the file
+    instead of each holding a copy. IO_FLAG_MMAP only maps the lists of IVF indexes, IO_FLAG_MMAP_IFC of newer
+    versions of faiss maps the vectors of every index type."""
+    import faiss
+
+    if not mapped:
+        return faiss.read_index(path)
+    return faiss.read_index(path, getattr(faiss, 'IO_FLAG_MMAP_IFC', faiss.IO_FLAG_MMAP))
+
+
+def _atomic_write(path: str, write):
+    """Write a file through a temporary file and a rename, so readers never see a partial file."""
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        write(tmp_path)
+        with open(tmp_path, 'rb') as f:
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class _ParagraphStore:
+    """Paragraphs stored as an offsets array plus a UTF-8 blob, read through mmap.
+
+    Layout: header (magic, version, count), ``count + 1`` little-endian uint64 offsets, ``count`` int32 token
+    counts (-1 when unknown, absent in version 1), then the blob.
+    Paragraphs appended after loading are kept in memory until the store is written again.
+    """
+
+    _MAGIC = b'CWPS'
+    _VERSION = 2
+    _HEADER = struct.Struct('<4sIQ')
+
+    def __init__(self, path: str = None):
+        self._mmap = None
+        self._offsets = np.zeros(1, dtype='<u8')
+        self._tokens = None
+        self._blob_start = 0
+        self._tail = []
+        if path is not None:
+            with open(path, 'rb') as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, version, count = self._HEADER.unpack_from(self._mmap, 0)
+            if magic != self._MAGIC or version not in (1, self._VERSION):
+                raise ValueError(f'{path} is not a paragraph store')
+            self._offsets = np.frombuffer(self._mmap, dtype='<u8', count=count + 1, offset=self._HEADER.size)
+            self._blob_start = self._HEADER.size + self._offsets.nbytes
+            if version >= 2:
+                self._tokens = np.frombuffer(self._mmap, dtype='<i4', count=count, offset=self._blob_start)
+                self._blob_start += self._tokens.nbytes
+
+    @classmethod
+    def count(cls, path: str) -> int:
+        """Read the number of paragraphs from the header only."""
+        with open(path, 'rb') as f:
+            _, _, count = cls._HEADER.unpack(f.read(cls._HEADER.size))
+        return count
+
+    @classmethod
+    def write(cls, path: str, texts: list[str]):
+        """Write the paragraphs and the token counts of those that know them to the path atomically."""
+        blobs = [text.encode('utf-8') for text in texts]
+        offsets = np.zeros(len(blobs) + 1, dtype='<u8')
+        np.cumsum([len(b) for b in blobs], out=offsets[1:])
+        tokens = np.array([-1 if num_tokens(text) is None else num_tokens(text) for text in texts], dtype='<i4')
+
+        def write(tmp_path):
+            with open(tmp_path, 'wb') as f:
+                f.write(cls._HEADER.pack(cls._MAGIC, cls._VERSION, len(blobs)))
+                f.write(offsets.tobytes())
+                f.write(tokens.tobytes())
+                for blob in blobs:
+                    f.write(blob)
+
+        _atomic_write(path, write)
+
+    def append(self, text: str):
+        """Append a paragraph in memory."""
+        self._tail.append(text)
+
+    def __len__(self):
+        return len(self._offsets) - 1 + len(self._tail)
+
+    def close(self):
+        """Unmap the file, the paragraphs stored in it can not be read anymore."""
+        if self._mmap is None:
+            return
+        # the arrays are views of the mapping, which can not be closed while they exist
+        self._offsets = self._offsets.copy()
+        if self._tokens is not None:
+            self._tokens = self._tokens.copy()
+        self._mmap.close()
+
+    def __getitem__(self, i: int) -> Fragment:
+        base = len(self._offsets) - 1
+        if i >= base:
+            text = self._tail[i - base]
+            return Fragment(text, num_tokens(text))
+        start = self._blob_start + int(self._offsets[i])
+        end = self._blob_start + int(self._offsets[i + 1])
+        tokens = int(self._tokens[i]) if self._tokens is not None else -1
+        return Fragment(self._mmap[start:end].decode('utf-8'), tokens if tokens >= 0 else None)
+
+    def texts(self) -> list[Fragment]:
+        """Get all paragraphs."""
+        return [self[i] for i in range(len(self))]
+
+    @property
+    def nbytes(self) -> int:
+        """The resident size, the blob is paged in by the OS on demand."""
+        return self._offsets.nbytes + sum(len(text) for text in self._tail)
+
+
+class _WriteAheadLog:
+    """Append-only log of paragraphs and vectors added since the index was last compacted.
+
+    The log starts with a header (magic, version, record count, id after the last record, committed length),
+    each record is a header (paragraph id, text length, dimensions, token count, crc32) followed by the UTF-8
+    text and the float32 vector. Records are written after the committed length and then committed by writing
+    the header again, so an append does not read the log, and a record torn by a crash is dropped by the next
+    one. Logs of versions 1 and 2 have no count in their header, they are rewritten on their first append.
+    """
+
+    _MAGIC = b'CWWL'
+    _VERSION = 3
+    _FILE_HEADER = struct.Struct('<4sIQQQ')
+    _FILE_HEADER_V2 = struct.Struct('<4sI')
+    _HEADER = struct.Struct('<QIIiI')
+    _HEADER_V1 = struct.Struct('<QIII')
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def _version(self, data: bytes) -> int:
+        if len(data) >= self._FILE_HEADER_V2.size and data[:len(self._MAGIC)] == self._MAGIC:
+            return self._FILE_HEADER_V2.unpack_from(data, 0)[1]
+        return 1 if data else self._VERSION
+
+    def read(self) -> list[tuple[int, Fragment, np.ndarray]]:
+        """Read the committed records."""
+        records = []
+        if not os.path.exists(self.path):
+            return records
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        version = self._version(data)
+        header = self._HEADER_V1 if version == 1 else self._HEADER
+        pos, length = 0, len(data)
+        if version == 2:
+            pos = self._FILE_HEADER_V2.size
+        elif version >= 3:
+            # a log whose header was torn while it was created has no records
+            if len(data) < self._FILE_HEADER.size:
+                return records
+            length = min(length, self._FILE_HEADER.unpack_from(data, 0)[4])
+            pos = self._FILE_HEADER.size
+        while pos + header.size <= length:
+            if version == 1:
+                paragraph_id, text_len, dims, crc = header.unpack_from(data, pos)
+                tokens = -1
+            else:
+                paragraph_id, text_len, dims, tokens, crc = header.unpack_from(data, pos)
+            start = pos + header.size
+            end = start + text_len + dims * 4
+            if end > length or zlib.crc32(data[start:end]) != crc:
+                break
+            text = Fragment(data[start:start + text_len].decode('utf-8'), tokens if tokens >= 0 else None)
+            vector = np.frombuffer(data, dtype='<f4', count=dims, offset=start + text_len)
+            records.append((paragraph_id, text, vector))
+            pos = end
+        return records
+
+    def state(self) -> tuple[int, int]:
+        """The number of records and the id after the last one, from the header only."""
+        header = self._header()
+        if header is None:
+            records = self.read()
+            return len(records), max([r[0] + 1 for r in records], default=0)
+        return header[0], header[1]
+
+    def append(self, records: list[tuple[int, str, np.ndarray]]) -> int:
+        """Append records after the committed ones, dropping any torn record left by a crash, and return the
+        number of records of the log."""
+        if self._header() is None:
+            self._rewrite(self.read())
+        with open(self.path, 'r+b') as f:
+            count, next_id, length = self._FILE_HEADER.unpack(f.read(self._FILE_HEADER.size))[2:]
+            f.truncate(length)
+            f.seek(length)
+            for paragraph_id, text, vector in records:
+                f.write(self._pack(paragraph_id, text, vector))
+                next_id = max(next_id, paragraph_id + 1)
+            length = f.tell()
+            f.flush()
+            os.fsync(f.fileno())
+            # the records are only committed once they are on disk
+            f.seek(0)
+            f.write(self._FILE_HEADER.pack(self._MAGIC, self._VERSION, count + len(records), next_id, length))
+            f.flush()
+            os.fsync(f.fileno())
+        return count + len(records)
+
+    def _header(self) -> Optional[tuple[int, int, int]]:
+        """The record count, next id and committed length, None for a missing or older log."""
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read(self._FILE_HEADER.size)
+        except FileNotFoundError:
+            return None
+        if len(data) < self._FILE_HEADER.size or self._version(data) != self._VERSION:
+            return None
+        return self._FILE_HEADER.unpack(data)[2:]
+
+    def _rewrite(self, records: list[tuple[int, str, np.ndarray]]):
+        payload = b''.join(self._pack(paragraph_id, text, vector) for paragraph_id, text, vector in records)
+        header = self._FILE_HEADER.pack(self._MAGIC, self._VERSION, len(records),
+                                        max([r[0] + 1 for r in records], default=0),
+                                        self._FILE_HEADER.size + len(payload))
+
+        def write(path):
+            with open(path, 'wb') as f:
+                f.write(header)
+                f.write(payload)
+
+        _atomic_write(self.path, write)
+
+    def _pack(self, paragraph_id: int, text: str, vector: np.ndarray) -> bytes:
+        payload = text.encode('utf-8') + np.asarray(vector, dtype='<f4').tobytes()
+        tokens = num_tokens(text)
+        return self._HEADER.pack(paragraph_id, len(payload) - len(vector) * 4, len(vector),
+                                 -1 if tokens is None else tokens, zlib.crc32(payload)) + payload
+
+    def delete(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
 
 class _IndexStorage(Storage):
-    """IndexStorage class."""
+    """IndexStorage class.
+
+    A document is a compacted base ({name}.para and {name}.bin) plus a write-ahead log ({name}.wal) of the
+    paragraphs added since, which is replayed on load and folded into the base by compaction. Its BM25 index
+    ({name}.bm25) is built when it is first added, and again on the first search after paragraphs were added.
+
+    Several processes of the API can share the index path: writers of a document hold an exclusive lock on
+    {name}.lock, loading it takes a shared one, and each process reloads a cached document once its files changed.
+    """
+
+    # serializes the writers of this process, readers go through the cache
+    _write_lock = threading.RLock()
 
     def __init__(self, cfg: Config):
         """Initialize the storage."""
         self._cfg = cfg
+        self._cache = _get_index_cache(cfg)
+        self._hybrid_search = cfg.hybrid_search
+        self._rrf_k = cfg.hybrid_rrf_k
 
     def add_all(self, embeddings: list[tuple[str, list[float]]], name):
         """Add multiple embeddings."""
+        with self._writing(name):
+            self._delete_meta(name)
+            if not self.been_indexed(name):
+                texts = _ParagraphStore()
+                for text, _ in embeddings:
+                    texts.append(text)
+                array = np.array([emb for _, emb in embeddings], dtype='float32')
+                # the index is created on the first ingest, so that IVF can be trained on the document
+                index = _create_index(array, self._cfg)
+                index.add_with_ids(array, np.arange(len(embeddings)))
+                self._save(texts, index, name)
+                self._wal(name).delete()
+                self._write_bm25(name, BM25Index.build(texts.texts()))
+            else:
+                self._migrate_csv(name)
+                # only the new paragraphs are written, the base files stay untouched until compaction
+                wal = self._wal(name)
+                next_id = self._count(name)
+                count = wal.append([(next_id + i, text, emb) for i, (text, emb) in enumerate(embeddings)])
+                if count >= self._cfg.index_compact_threshold:
+                    threading.Thread(target=self.compact, args=(name,), daemon=True).start()
+            self._cache.invalidate(self._cache_key(name))
+            self._cache.invalidate(self._cache_key(f'{name}.bm25'))
+
+    def compact(self, name: str):
+        """Fold the write-ahead log into the base files."""
+        with self._writing(name):
+            if not self.been_indexed(name) or not os.path.exists(self._path(name, 'wal')):
+                return
+            self._migrate_csv(name)
+            texts, index = self._read(name)
+            # the cached paragraphs are closed before their file is replaced
+            self._cache.invalidate(self._cache_key(name))
+            # the paragraphs are written before the index, see _read for how a crash in between is recovered
+            self._save(texts, index, name)
+            self._wal(name).delete()
+            print(f"Compacted {name} with {len(texts)} paragraphs")
+
+    def get_texts(self, embedding: list[float], name: str, limit=100, query: str = None) -> list[str]:
+        """Get the text for the provided embedding, fused with a BM25 search of the query if it is given."""
+        return self.get_texts_batch([embedding], name, limit, [query])[0]
+
+    def get_texts_batch(self, embeddings: list[list[float]], name: str, limit=100,
+                        queries: list[str] = None) -> list[list[str]]:
+        """Get the texts for each of the provided embeddings and queries, searched together."""
+        if not embeddings:
+            return []
         texts, index = self._load(name)
-        ids = np.array([len(texts) + i for i, _ in enumerate(embeddings)])
-        texts = pd.concat([texts, pd.DataFrame(
-            {'index': len(texts) + i, 'text': text} for i, (text, _) in enumerate(embeddings))])
-        array = np.array([emb for text, emb in embeddings])
-        index.add_with_ids(array, ids)
-        self._save(texts, index, name)
-
-    def get_texts(self, embedding: list[float], name: str, limit=100) -> list[str]:
-        """Get the text for the provided embedding."""
-        texts, index = self._load(name)
-        _, indexs = index.search(np.array([embedding]), limit)
-        indexs = [i for i in indexs[0] if i >= 0]
-        return [f'paragraph {p}: {t}' for _, p, t in texts.iloc[indexs].values]
+        distances, indexs = index.search(np.array(embeddings, dtype='float32'), limit)
+        # the inner product of normalized embeddings is their cosine similarity
+        scores = [{i: d for i, d in zip(row, distance) if i >= 0}
+                  for row, distance in zip(indexs.tolist(), distances.tolist())]
+        rows = [list(row_scores) for row_scores in scores]
+        if self._hybrid_search and queries and any(queries):
+            bm25 = self._load_bm25(name, texts)
+            rows = [reciprocal_rank_fusion([row, [i for i, _ in bm25.search(query, limit)]], limit, self._rrf_k)
+                    if query else row for row, query in zip(rows, queries)]
+        return [[_label(f'paragraph {i}: ', texts[i], row_scores.get(i)) for i in row]
+                for row, row_scores in zip(rows, scores)]
 
     def get_all_embeddings(self, name: str):
         texts, index = self._load(name)
-        texts = texts.text.tolist()
+        texts = texts.texts()
         embeddings = index.reconstruct_n(0, len(texts))
         return list(zip(texts, embeddings))
 
+    def create_collection(self, collection: str, names: list[str]):
+        """Create or replace a collection of documents that are searched together.
+
+        The documents share one index whose ids are the member number in the high 32 bits and the paragraph
+        number in the low 32 bits.
+        """
+        import faiss
+
+        with self._writing(f'{collection}.collection'):
+            names = [name for name in dict.fromkeys(names) if self.been_indexed(name)]
+            vectors = []
+            ids = []
+            for member, name in enumerate(names):
+                texts, index = self._load(name)
+                vectors.append(index.reconstruct_n(0, len(texts)))
+                ids.append((member << 32) | np.arange(len(texts), dtype='int64'))
+            if not vectors:
+                raise ValueError(f'no indexed document in collection {collection}')
+            vectors = np.concatenate(vectors)
+            index = _create_index(vectors, self._cfg)
+            index.add_with_ids(vectors, np.concatenate(ids))
+            # the cached index is dropped before its file is replaced
+            self._cache.invalidate(self._cache_key(f'{collection}.collection'))
+            _atomic_write(self._path(collection, 'collection.bin'), lambda path: faiss.write_index(index, path))
+            manifest = {'names': names, 'versions': [self._version(name) for name in names]}
+
+            def write(path):
+                with open(path, 'w') as f:
+                    json.dump(manifest, f)
+
+            _atomic_write(self._path(collection, 'collection'), write)
+            print(f"Created collection {collection} with {len(names)} documents and {len(vectors)} paragraphs")
+
+    def get_collection_texts(self, embedding: list[float], collection: str, limit=100, query: str = None) \
+            -> list[str]:
+        """Get the text for the provided embedding from all documents of the collection, merged by score, and
+        fused with a BM25 search of the query over its documents if it is given."""
+        members, index = self._load_collection(collection)
+        distances, indexs = index.search(np.array([embedding], dtype='float32'), limit)
+        scores = {i: d for i, d in zip(indexs[0].tolist(), distances[0].tolist()) if i >= 0}
+        ids = list(scores)
+        if self._hybrid_search and query:
+            # the BM25 scores of the documents are merged as they are, each with its own term statistics
+            found = []
+            for member, (name, texts) in enumerate(members):
+                found += [(score, (member << 32) | i) for i, score in self._load_bm25(name, texts).search(query, limit)]
+            found.sort(key=lambda item: -item[0])
+            ids = reciprocal_rank_fusion([ids, [i for _, i in found[:limit]]], limit, self._rrf_k)
+        result = []
+        for i in ids:
+            name, texts = members[i >> 32]
+            paragraph = i & 0xFFFFFFFF
+            result.append(_label(f'document {name} paragraph {paragraph}: ', texts[paragraph], scores.get(i)))
+        return result
+
+    def _load_collection(self, collection: str):
+        path = self._path(collection, 'collection')
+        if not os.path.exists(path):
+            raise ValueError(f'collection {collection} not found')
+        with open(path) as f:
+            manifest = json.load(f)
+        # a member that changed since the collection was built makes the shared index stale
+        if manifest['versions'] != [self._version(name) for name in manifest['names']]:
+            self.create_collection(collection, manifest['names'])
+            with open(path) as f:
+                manifest = json.load(f)
+
+        def loader():
+            with _file_lock(self._path(f'{collection}.collection', 'lock'), False):
+                members = [(name, self._read_texts(name)) for name in manifest['names']]
+                index = _read_index(self._path(collection, 'collection.bin'), self._cfg.index_mmap)
+            _tune_index(index, self._cfg)
+            size = index.ntotal * index.d * 4 + sum(texts.nbytes for _, texts in members)
+            return (members, index), size
+
+        # the manifest is written again whenever the collection is built, in this process or another one
+        stat = os.stat(path)
+        return self._cache.get(self._cache_key(f'{collection}.collection'), loader, [stat.st_size, stat.st_mtime_ns],
+                               lambda value: self._release([texts for _, texts in value[0]]))
+
+    def _version(self, name: str) -> list[int]:
+        """Sizes and modification times of the files of a document, they change whenever it is written."""
+        version = []
+        for ext in ['para', 'wal']:
+            try:
+                stat = os.stat(self._path(name, ext))
+                version += [stat.st_size, stat.st_mtime_ns]
+            except FileNotFoundError:
+                version += [0, 0]
+        return version
+
+    def get_meta(self, name: str) -> dict:
+        """Get the metadata of the document, stored as {name}.meta.json."""
+        try:
+            with open(self._path(name, 'meta.json'), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def set_meta(self, name: str, meta: dict):
+        """Set the metadata of the document, it is dropped when paragraphs are added or the document is cleared."""
+
+        def write(path):
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(meta, f, ensure_ascii=False)
+
+        with self._writing(name):
+            _atomic_write(self._path(name, 'meta.json'), write)
+
     def clear(self, name: str):
         """Clear the database."""
-        self._delete(name)
+        with self._writing(name):
+            self._cache.invalidate(self._cache_key(name))
+            self._cache.invalidate(self._cache_key(f'{name}.bm25'))
+            self._delete(name)
+
+    def stats(self) -> dict:
+        """Get the index cache statistics."""
+        return {'index_cache': self._cache.stats()}
 
     def been_indexed(self, name: str) -> bool:
-        return os.path.exists(os.path.join(self._cfg.index_path, f'{name}.csv')) and os.path.exists(
-            os.path.join(self._cfg.index_path, f'{name}.bin'))
+        return (os.path.exists(self._path(name, 'para')) or os.path.exists(self._path(name, 'csv'))) \
+            and os.path.exists(self._path(name, 'bin'))
 
-    def _save(self, texts, index, name: str):
-        texts.to_csv(os.path.join(self._cfg.index_path, f'{name}.csv'))
-        faiss.write_index(index, os.path.join(self._cfg.index_path, f'{name}.bin'))
+    def _path(self, name: str, ext: str) -> str:
+        return os.path.join(self._cfg.index_path, f'{name}.{ext}')
 
-    def _load(self, name: str):
-        if self.been_indexed(name):
-            texts = pd.read_csv(os.path.join(self._cfg.index_path, f'{name}.csv'))
-            index = faiss.read_index(os.path.join(self._cfg.index_path, f'{name}.bin'))
-        else:
-            texts = pd.DataFrame(columns=['index', 'text'])
-            # IDMap2 with Flat
-            index = faiss.index_factory(1536, "IDMap2,Flat", faiss.METRIC_INNER_PRODUCT)
-        return texts, index
+    def _wal(self, name: str) -> _WriteAheadLog:
+        return _WriteAheadLog(self._path(name, 'wal'))
 
-    def _delete(self, name: str):
-        try:
-            os.remove(os.path.join(self._cfg.index_path, f'{name}.csv'))
-            os.remove(os.path.join(self._cfg.index_path, f'{name}.bin'))
-        except FileNotFoundError:
-            pass
+    @contextmanager
+    def _writing(self, name: str):
+        """Serialize the writers of the document, the threads of this process and the other API processes."""
+        with self._write_lock, _file_lock(self._path(name, 'lock'), True):
+            yield
 
+    def _save(self, texts: _ParagraphStore, index, name: str):
+        import faiss
 
-def singleton(cls):
-    instances = {}
+        paragraphs = texts.texts()
+        # a mapped file can not be replaced on Windows
+        texts.close()
+        _ParagraphStore.write(self._path(name, 'para'), paragraphs)
+        _atomic_write(self._path(name, 'bin'), lambda path: faiss.write_index(index, path))
 
-    def get_instance(cfg):
-        if cls not in instances:
-            instances[cls] = cls(cfg)
-        return instances[cls]
+    def _cache_key(self, name: str):
+        return os.path.abspath(self._cfg.index_path), name
 
-    return get_instance
+    def _load(self, name: str):
+        if not self.been_indexed(name):
+            return self._read(name)
+        self._ensure_migrated(name)
 
+        def loader():
+            # a writer replaces the base files and then deletes the log, the lock keeps them consistent
+            with _file_lock(self._path(name, 'lock'), False):
+                texts, index = self._read(name, self._cfg.index_mmap)
+            size = index.ntotal * index.d * 4 + texts.nbytes
+            return (texts, index), size
 
-@singleton
-class _PostgresStorage(Storage):
-    """PostgresStorage class."""
+        return self._cache.get(self._cache_key(name), loader, self._version(name),
+                               lambda value: self._release([value[0]]))
 
-    def __init__(self, cfg: Config):
-        """Initialize the storage."""
-        self._postgresql = cfg.postgres_url
-        self._engine = create_engine(self._postgresql)
-        Base.metadata.create_all(self._engine)
-        session = sessionmaker(bind=self._engine)
-        self._session = session()
+    @staticmethod
+    def _release(stores: list[_ParagraphStore]):
+        """Close the paragraph stores of a value dropped from the cache. On Windows a mapped file can not be replaced
+        or removed, elsewhere they are left to the garbage collector, as a request may still be reading them."""
+        if os.name == 'nt':
+            for texts in stores:
+                texts.close()
 
-    def add_all(self, embeddings: list[tuple[str, list[float]]], name: str):
-        """Add multiple embeddings."""
-        data = [self.EmbeddingEntity(text=text, embedding=embedding, name=name) for text, embedding in embeddings]
-        self._session.add_all(data)
-        self._session.commit()
+    def _read(self, name: str, mapped: bool = False):
+        import faiss
 
-    def get_texts(self, embedding: list[float], name: str, limit=100) -> list[str]:
-        """Get the text for the provided embedding."""
-        result = self._session.query(self.EmbeddingEntity).where(self.EmbeddingEntity.name == name).order_by(
-            self.EmbeddingEntity.embedding.cosine_distance(embedding)).limit(limit).all()
-        return [f'paragraph {s.id}: {s.text}' for s in result]
+        if self.been_indexed(name):
+            texts = _ParagraphStore(self._path(name, 'para'))
+            records = self._wal(name).read()
+            # vectors can not be added to a mapped index, one with paragraphs in the log is read into memory
+            # until it is compacted
+            index = _read_index(self._path(name, 'bin'), mapped and not records)
+            _tune_index(index, self._cfg)
+            # a crash during compaction can leave the paragraphs ahead of the index, so both are
+            # checked separately and the log only fills in what each one is missing
+            for paragraph_id, text, vector in records:
+                if paragraph_id >= len(texts):
+                    texts.append(text)
+            missing = [(paragraph_id, vector) for paragraph_id, _, vector in records if paragraph_id >= index.ntotal]
+            if missing:
+                index.add_with_ids(np.array([vector for _, vector in missing]),
+                                   np.array([paragraph_id for paragraph_id, _ in missing]))
+        else:
+            texts = _ParagraphStore()
+            # IDMap2 with Flat
+            index = faiss.index_factory(1536, "IDMap2,Flat", faiss.METRIC_INNER_PRODUCT)
+        return texts, index
 
-    def get_all_embeddings(self, name: str):
-        """Get all embeddings."""
-        result = self._session.query(self.EmbeddingEntity).where(self.EmbeddingEntity.name == name).all()
-        return [(s.text, s.embedding) for s in result]
+    def _load_bm25(self, name: str, texts: _ParagraphStore) -> BM25Index:
+        """The BM25 index of the paragraphs, built again when paragraphs were added since it was written."""
+        key = self._cache_key(f'{name}.bm25')
+
+        def loader():
+            bm25 = None
+            if os.path.exists(self._path(name, 'bm25')):
+                with open(self._path(name, 'bm25'), 'rb') as f:
+                    bm25 = BM25Index.read(f)
+            if bm25 is None or bm25.count != len(texts):
+                bm25 = BM25Index.build(texts.texts())
+                # the sidecar is written like the other files of the document, unless it was written to since
+                with self._writing(name):
+                    if self.been_indexed(name) and self._count(name) == bm25.count:
+                        self._write_bm25(name, bm25)
+            return bm25, bm25.nbytes
+
+        bm25 = self._cache.get(key, loader)
+        if bm25.count != len(texts):
+            # the paragraphs were loaded after the cached index was built
+            self._cache.invalidate(key)
+            bm25 = self._cache.get(key, loader)
+        return bm25
+
+    def _count(self, name: str) -> int:
+        """The number of paragraphs of an indexed document, from the headers of its files."""
+        return max(_ParagraphStore.count(self._path(name, 'para')), self._wal(name).state()[1])
+
+    def _write_bm25(self, name: str, bm25: BM25Index):
+        def write(path):
+            with open(path, 'wb') as f:
+                bm25.write(f)
+
+        _atomic_write(self._path(name, 'bm25'), write)
+
+    def _read_texts(self, name: str) -> _ParagraphStore:
+        """Read the paragraphs of a document without its index."""
+        texts = _ParagraphStore(self._path(name, 'para'))
+        records = self._wal(name).read()
+        for paragraph_id, text, _ in records:
+            if paragraph_id >= len(texts):
+                texts.append(text)
+        return texts
+
+    def _ensure_migrated(self, name: str):
+        """Migrate a document saved by older versions, before a reader takes the shared lock of the document."""
+        if not os.path.exists(self._path(name, 'para')) and os.path.exists(self._path(name, 'csv')):
+            with self._writing(name):
+                self._migrate_csv(name)
+
+    def _migrate_csv(self, name: str):
+        """Convert an index saved by older versions from csv to the paragraph store, the caller holds _writing."""
+        import pandas as pd
+
+        # another thread or process may have migrated it while the caller waited for the lock
+        if os.path.exists(self._path(name, 'para')) or not os.path.exists(self._path(name, 'csv')):
+            return
+        texts = pd.read_csv(self._path(name, 'csv'), keep_default_na=False)
+        _ParagraphStore.write(self._path(name, 'para'), texts.sort_values('index').text.astype(str).tolist())
+        os.remove(self._path(name, 'csv'))
+        print(f"Migrated {name}.csv to {name}.para")
 
-    def clear(self, name: str):
-        """Clear the database."""
-        self._session.query(self.EmbeddingEntity).where(self.EmbeddingEntity.name == name).delete()
-        self._session.commit()
+    def _delete(self, name: str):
+        for ext in ['para', 'csv', 'bin', 'wal', 'bm25']:
+            try:
+                os.remove(self._path(name, ext))
+            except FileNotFoundError:
+                pass
+        self._delete_meta(name)
+
+    def _delete_meta(self, name: str):
+        try:
+            os.remove(self._path(name, 'meta.json'))
+        except FileNotFoundError:
+            pass
 
-    def been_indexed(self, name: str) -> bool:
-        return self._session.query(self.EmbeddingEntity).filter_by(name=name).first() is not None
-
-    def __del__(self):
-        """Close the session."""
-        self._session.close()
-
-    class EmbeddingEntity(Base):
-        __tablename__ = 'embedding'
-        id = Column(Integer, primary_key=True)
-        name = Column(String)
-        text = Column(String)
-        embedding = Column(Vector(1536))
+
+def _label(label: str, text: str, score: Optional[float] = None) -> Fragment:
+    return Fragment(text, num_tokens(text), label, score)
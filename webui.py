@@ -1,10 +1,10 @@
 import gradio as gr
-import xxhash
 from gradio.components import _Keywords
 
 from ai import AI
 from config import Config
 from contents import *
+from ingest import get_hash_id, save_to_storage
 from storage import Storage
 
 
@@ -18,19 +18,11 @@ class Webui:
         self.cfg = cfg
         self.ai = AI(cfg)
 
-    def _save_to_storage(self, contents, hash_id):
+    def _save_to_storage(self, contents, hash_id, lang):
         print(f"Saving to storage {hash_id}")
         print(f"Contents: \n{contents}")
         self.storage = Storage.create_storage(self.cfg)
-        if self.storage.been_indexed(hash_id):
-            return 0
-        else:
-            embeddings, tokens = self.ai.create_embeddings(contents)
-            self.storage.add_all(embeddings, hash_id)
-            return tokens
-
-    def _get_hash_id(self, contents):
-        return xxhash.xxh3_128_hexdigest('\n'.join(contents))
+        return save_to_storage(self.ai, self.storage, contents, hash_id, lang)
 
     def run(self):
         with gr.Blocks() as demo:
@@ -54,8 +46,8 @@ class Webui:
                             content, lang = web_crawler_newspaper(url)
                             if len(content) == 0:
                                 return {url_error_box: gr.update(value="Can not crawl this url", visible=True)}
-                            hash_id = self._get_hash_id(content)
-                            self._save_to_storage(content, hash_id)
+                            hash_id = get_hash_id(content)
+                            self._save_to_storage(content, hash_id, lang)
                         except Exception as e:
                             return {url_error_box: gr.update(value=str(e), visible=True)}
                         return {
@@ -80,7 +72,7 @@ class Webui:
                     def submit(file):
                         url = file.name
                         if url.endswith('.pdf'):
-                            contents, lang = extract_text_from_pdf(url)
+                            contents, lang = extract_text_from_pdf(url, self.cfg.pdf_workers)
                         elif url.endswith('.txt'):
                             contents, lang = extract_text_from_txt(url)
                         elif url.endswith('.docx'):
@@ -90,8 +82,8 @@ class Webui:
 
                         if len(contents) == 0:
                             return {file_error_box: gr.update(value="Empty file", visible=True)}
-                        hash_id = self._get_hash_id(contents)
-                        self._save_to_storage(contents, hash_id)
+                        hash_id = get_hash_id(contents)
+                        self._save_to_storage(contents, hash_id, lang)
 
                         return {
                             init_page: gr.update(visible=False),
@@ -129,18 +121,23 @@ class Webui:
                         )
 
                 def respond(message, chat_history, hash_id):
-                    kw = self.ai.get_keywords(message)
-                    if len(kw) == 0 or hash_id is None:
-                        return "", chat_history
-                    _, kw_ebd = self.ai.create_embedding(kw)
-                    ctx = self.storage.get_texts(kw_ebd, hash_id)
+                    if hash_id is None:
+                        yield "", chat_history
+                        return
+                    kw, kw_ebd = self.ai.get_query_embedding(message)
+                    if kw_ebd is None:
+                        yield "", chat_history
+                        return
+                    ctx = self.storage.get_texts(kw_ebd, hash_id, self.ai.search_limit, kw)
                     print(f"Context: \n{ctx}")
-                    bot_message = self.ai.completion(message, ctx)
-                    chat_history.append((message, bot_message))
                     contexts = [[item] for item in ctx][:20]
                     keywords = [[item.strip()] for item in kw.split(',')]
                     visible = gr.update(visible=True)
-                    return "", chat_history, contexts, keywords, visible, visible
+                    chat_history.append([message, ""])
+                    for content in self.ai.completion_stream(message, ctx):
+                        chat_history[-1][1] += content
+                        yield "", chat_history, contexts, keywords, visible, visible
+                    yield "", chat_history, contexts, keywords, visible, visible
 
                 def reset():
                     return {
@@ -169,4 +166,6 @@ class Webui:
                     [init_page, chat_page, chatbot, msg, kw_box, dataset_box, hash_id_state]
                 )
         demo.title = "Chat Web"
+        # the queue is needed to stream the answers of the generator
+        demo.queue()
         demo.launch(server_port=self.cfg.webui_port, server_name=self.cfg.webui_host, show_api=False)